@@ -0,0 +1,597 @@
+import asyncio
+import json
+import signal
+import socket
+import sys
+import time
+import traceback
+from InternetController import *
+from InternetController import _family, _icmp_socket
+
+async def async_interface_list():
+    """`dispatch list` without blocking the event loop"""
+    metrics.inc("dispatch_list_invocations_total")
+    process = await asyncio.create_subprocess_exec(DISPATCH_EXE, "list", stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.DEVNULL)
+    stdout, _ = await process.communicate()
+    return parse_interface_list(stdout.decode('utf-8', errors='ignore'))
+
+async def async_resolve(adr, interface):
+    hit, addresses = dns_cache.peek(adr, interface)
+    if hit:
+        return addresses
+    dns_cache.start()  # same as DnsCache.lookup: the refresher keeps the entries warm in the background
+    # Resolution itself blocks (getaddrinfo), asyncio runs it in its default executor too
+    return await asyncio.to_thread(dns_cache.resolve, adr, interface)
+
+async def async_icmp_probe(target, interface, seq=None):
+    """Same as icmp_probe, on the event loop"""
+    family = _family(target)
+    sock = _icmp_socket(family)
+    if sock is None:
+        raise PermissionError("ICMP sockets are not permitted")
+    loop = asyncio.get_running_loop()
+    packet, expected = icmp_echo_packet(family, target, seq)
+    with sock:
+        sock.setblocking(False)
+        try:
+            if interface:
+                sock.bind((interface, 0))
+            # A connected socket only receives from the target (so icmp_is_reply needn't check the source),
+            # and works with sock_sendall/sock_recv
+            sock.connect((target, 0))
+            start = time.perf_counter()
+            await loop.sock_sendall(sock, packet)
+            deadline = start + PROBE_TIMEOUT
+            while True:
+                data = await asyncio.wait_for(loop.sock_recv(sock, 2048), max(0, deadline - time.perf_counter()))
+                if icmp_is_reply(sock, data, expected):
+                    return (time.perf_counter() - start) * 1000
+        except (OSError, asyncio.TimeoutError):
+            return None
+
+async def async_tcp_probe(target, interface):
+    start = time.perf_counter()
+    try:
+        local_addr = (interface, 0) if interface else None
+        _, writer = await asyncio.wait_for(asyncio.open_connection(target, PROBE_PORT, local_addr=local_addr), PROBE_TIMEOUT)
+    except (OSError, asyncio.TimeoutError):
+        return None
+    elapsed = (time.perf_counter() - start) * 1000
+    writer.close()
+    return elapsed
+
+async def async_ping(adr, interface, n=4, full_stats=None):
+    """Async counterpart of ping(), with the same early exit rules and result shape"""
+    if PROBE_BACKEND in probe_backends or PROBE_BACKEND == "system":
+        return await asyncio.to_thread(ping, adr, interface, n, full_stats)
+    addresses = await async_resolve(adr, interface)
+    if not addresses:
+        return False,(None,None,None),(None,None,None)
+    method = PROBE_BACKEND
+    tally = PingTally(full_stats)
+    for _ in range(n):
+        rtt = None
+        if method in ("native", "icmp"):
+            try:
+                rtt = await async_icmp_probe(addresses[0], interface)
+            except PermissionError:
+                if method == "icmp":
+                    raise
+                method = "tcp"
+        if method == "tcp":
+            rtt = await async_tcp_probe(addresses[0], interface)
+        if tally.add(rtt):
+            break
+    return tally.result()
+
+class AsyncDispatch:
+    """Runs and watches the dispatch process on the event loop"""
+    def __init__(self, port=None):
+        self.port = port or DISPATCH_PORT  # always passed to dispatch, readiness is checked there
+        self.process = None
+        self.args = None
+        self.interfaces = []
+        self.stdout_buffer = RingBuffer()
+        self.stderr_buffer = RingBuffer()
+        self.stopping = False
+        self.crashes = CrashTracker()
+        self.ready = None
+        self.ready_pattern = re.compile(DISPATCH_READY_PATTERN) if DISPATCH_READY_PATTERN else None
+        self.lock = asyncio.Lock()  # restarts come from the monitoring loop and the health checks
+
+    async def _read(self, stream, buffer, label, ready):
+        while True:
+            line = await stream.readline()
+            if not line:
+                break
+            decoded = line.decode('utf-8', errors='ignore').rstrip()
+            buffer.append(decoded)
+            ServerController._check_banner(self, decoded, ready)
+            print(f"[{label}] {decoded}")
+
+    async def start(self, interfaces):
+        self.interfaces = list(interfaces)
+        self.args = ["start", "--port", str(self.port)] + self.interfaces
+        self.stopping = False
+        creationflags = subprocess.CREATE_NEW_PROCESS_GROUP if os.name == 'nt' else 0
+        try:
+            self.process = await asyncio.create_subprocess_exec(
+                DISPATCH_EXE, *self.args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                stdin=asyncio.subprocess.PIPE, creationflags=creationflags)
+        except OSError as e:
+            print(f"Failed to start server: {e}")
+            self.process = None
+            return False
+        print(f"Server started with PID: {self.process.pid}")
+        self.ready = asyncio.Event()
+        asyncio.create_task(self._read(self.process.stdout, self.stdout_buffer, "STDOUT", self.ready))
+        asyncio.create_task(self._read(self.process.stderr, self.stderr_buffer, "STDERR", self.ready))
+        asyncio.create_task(self._watch(self.process, time.time()))
+        start = time.perf_counter()
+        if await self.wait_ready():
+            print(f"Server ready after {time.perf_counter() - start:.2f}s")
+            return True
+        if self.process.returncode is None:
+            print(f"Server was not ready within {DISPATCH_READY_TIMEOUT}s, stopping it")
+            await self.stop()
+        return False
+
+    async def wait_ready(self, timeout=None):
+        """Same as ServerController.wait_ready: banner, or a connection accepted on the port, or False once it exited"""
+        process, wait = self.process, ReadyWait(self.ready, timeout)
+        while True:
+            result = wait.check(process.returncode is not None)
+            if result is None:
+                result = wait.check(False, await self._accepts())
+            if result is not None:
+                return result
+            pause = wait.pause()
+            if pause is None:
+                return False
+            try:
+                await asyncio.wait_for(wait.ready.wait(), pause)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _accepts(self):
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(DISPATCH_HOST, self.port), 0.2)
+            writer.close()
+            return True
+        except (OSError, asyncio.TimeoutError):
+            return False
+
+    async def _watch(self, process, started):
+        # Waiting on the process reports an exit right away, nothing is polled; same policy as DispatchSupervisor
+        code = await process.wait()
+        if not self.crashes.supervised(self, process):
+            return
+        await asyncio.sleep(0.1)  # let the readers take its last lines
+        delay = self.crashes.record(code, self.stderr_buffer, time.time() - started)
+        if delay is None:
+            return
+        await asyncio.sleep(delay)
+        if self.crashes.supervised(self, process):
+            print(f"Restarting dispatch after a crash (waited {delay:g}s)")
+            await self.start(self.interfaces)
+
+    async def stop(self):
+        process, self.stopping = self.process, True
+        if process is None or process.returncode is not None:
+            return
+        if os.name == 'nt':
+            process.send_signal(signal.CTRL_BREAK_EVENT)
+        else:
+            process.terminate()
+        try:
+            await asyncio.wait_for(process.wait(), 10)
+        except asyncio.TimeoutError:
+            print("Force killing server...")
+            process.kill()
+            await process.wait()
+        print("Server stopped")
+
+    async def restart(self, interfaces):
+        async with self.lock:
+            print("Restarting with:",interfaces)
+            metrics.inc("dispatch_restarts_total")
+            down = time.time()
+            await self.stop()
+            if interfaces:
+                await self.start(interfaces)
+            metrics.inc("dispatch_restart_downtime_seconds_total", time.time() - down)
+
+    def is_running(self):
+        return self.process is not None and self.process.returncode is None
+
+    def read_since(self, cursor=None):
+        return ServerController.read_since(self, cursor)
+
+class ControlServer:
+    """Local control API: newline-delimited JSON requests and replies, plus state and output pushed to subscribers"""
+    def __init__(self, daemon, max_backlog=1 << 20):
+        self.daemon = daemon
+        self.max_backlog = max_backlog
+        self.servers = []
+        self.subscribers = set()
+        self.last_state = None
+
+    async def start(self):
+        if CONTROL_PORT:
+            self.servers.append(await asyncio.start_server(self.handle, CONTROL_HOST, CONTROL_PORT))
+            print(f"Control API listening on {CONTROL_HOST}:{CONTROL_PORT}")
+        if CONTROL_SOCKET and hasattr(socket, "AF_UNIX"):
+            if os.path.exists(CONTROL_SOCKET):
+                os.unlink(CONTROL_SOCKET)  # left over by a daemon that didn't exit cleanly
+            self.servers.append(await asyncio.start_unix_server(self.handle, CONTROL_SOCKET))
+            print(f"Control API listening on {CONTROL_SOCKET}")
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    if request.get("cmd") == "subscribe":
+                        self.subscribers.add(writer)
+                        reply = self.daemon.state()
+                    else:
+                        reply = await self.daemon.command(request.get("cmd"), request)
+                    reply["ok"] = True
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
+                    reply = {"ok": False, "error": str(e)}
+                writer.write(self.encode(reply))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.subscribers.discard(writer)
+            writer.close()
+
+    def encode(self, message):
+        return (json.dumps(message) + "\n").encode()
+
+    def publish(self, message):
+        data = self.encode(message)
+        for writer in list(self.subscribers):
+            # A subscriber that stopped reading is dropped instead of buffering for it forever
+            if writer.is_closing() or writer.transport.get_write_buffer_size() > self.max_backlog:
+                self.subscribers.discard(writer)
+                writer.close()
+                continue
+            writer.write(data)
+
+    def publish_state(self):
+        """Push the state to subscribers if it changed since the last push"""
+        state = self.daemon.state()
+        if state != self.last_state:
+            self.last_state = state
+            self.publish(state)
+
+    async def close(self):
+        for server in self.servers:
+            server.close()
+            await server.wait_closed()
+        if CONTROL_SOCKET and os.path.exists(CONTROL_SOCKET):
+            os.unlink(CONTROL_SOCKET)
+
+class Daemon:
+    """Headless manager: inventory, probing and dispatch supervision on a single asyncio event loop"""
+    def __init__(self, names=None):
+        self.interfaces = [Interface(name) for name in (names or INTERFACES)]
+        # The pool holds every instance's port, interface group and restart damping, the daemon runs them asynchronously
+        self.pool = DispatchPool()
+        self.dispatches = {instance.name: AsyncDispatch(instance.port) for instance in self.pool.instances}
+        for instance in self.pool.instances:
+            self.check_mode(instance)
+        self.known = {}
+        self.pending = {}
+        self.semaphore = None
+        self.wake = None
+        self.stopping = None
+        self.netlink = None
+        self.enabled = True  # cleared by the stop command, dispatch stays down until start
+        self.control = ControlServer(self)
+        self.state_store = StateStore()
+
+    async def refresh_inventory(self):
+        try:
+            interfaces = await async_interface_list()
+        except OSError as e:
+            print(f"Failed to list interfaces: {e}")
+            return
+        index = inventory.store(interfaces)
+        # Same bookkeeping as InterfaceWatcher.check: only what changed gets probed right away
+        changed = {name for name in set(index) | set(self.known) if index.get(name) != self.known.get(name)}
+        self.known = index
+        for interface in self.interfaces:
+            if interface.name.lower() in changed:
+                interface.invalidate()
+
+    async def update(self, interface):
+        async with self.semaphore:
+            previous = interface.last_level
+            interface.record_time()
+            entry = inventory.index.get(interface.name.lower())
+            present = interface.note_addresses(entry[1] if entry else None)
+            if interface.begin_update(present):
+                results = {}
+                if present:
+                    targets = interface.planner.probe_targets()
+                    for probes in interface.planner.stages(interface.last_level):
+                        outcomes = await asyncio.gather(*[self.timed_probe(interface, probe, targets[probe]) for probe in probes])
+                        results.update(zip(probes, outcomes))
+                        if interface.planner.settled(interface.last_level, results):
+                            break
+                interface.apply_results(present, results, previous)
+            interface.record_level(previous)
+            if interface.last_level != previous:
+                print(f"{interface.name} - {interface.last_level}")
+
+    async def timed_probe(self, interface, probe, target):
+        start = time.perf_counter()
+        try:
+            return await async_ping(target, interface.ip)
+        finally:
+            metrics.observe("probe_duration_seconds", time.perf_counter() - start, interface=interface.name, probe=probe)
+
+    async def update_all(self):
+        """Probe every interface concurrently, waiting at most PROBE_DEADLINE"""
+        tasks = []
+        for interface in self.interfaces:
+            task = self.pending.get(interface)
+            if task is None or task.done():
+                task = self.pending[interface] = asyncio.create_task(self.update(interface))
+            tasks.append(task)
+        done, late = await asyncio.wait(tasks, timeout=PROBE_DEADLINE)
+        # An update that overran is left running, the next cycle waits for it instead of starting another one
+        for interface in self.interfaces:
+            task = self.pending[interface]
+            if task in done and task.exception():
+                error = task.exception()
+                print(f"Error while updating {interface.name}")
+                print("".join(traceback.format_exception(type(error), error, error.__traceback__)))
+        for interface in self.interfaces:
+            if self.pending[interface] in late:
+                print(f"{interface.name} did not finish probing within {PROBE_DEADLINE}s, keeping its last status")
+
+    def on_netlink(self):
+        # Drain the burst, the inventory refresh sees the end state
+        try:
+            while True:
+                self.netlink.sock.recv(65536)
+        except BlockingIOError:
+            pass
+        asyncio.ensure_future(self.refresh_inventory()).add_done_callback(lambda _: self.wake.set())
+
+    def reprobe(self, names=None):
+        for interface in self.interfaces:
+            if names is None or interface.name.lower() in names:
+                interface.invalidate()
+        self.wake.set()
+
+    def instance_state(self, instance):
+        dispatch = self.dispatches[instance.name]
+        return {
+            "name": instance.name,
+            "port": dispatch.port,
+            "running": dispatch.is_running(),
+            "pid": dispatch.process.pid if dispatch.is_running() else None,
+            "proxies": [{"name": interface.name, "ip": interface.ip, "weight": dispatch_key(interface, instance.priorities)[1]}
+                        for interface in instance.available],
+            "restarts": instance.damper.restarts,
+            "suppressed": instance.damper.suppressed,
+            "crashes": len(dispatch.crashes.crashes),
+            "last_crash": dispatch.crashes.last(),
+            "health": instance.health.last,
+            "health_restarts": instance.health.restarts,
+        }
+
+    def state(self):
+        instances = [self.instance_state(instance) for instance in self.pool.instances]
+        proxies = []
+        for instance in instances:
+            if instance["running"]:
+                proxies += [proxy for proxy in instance["proxies"] if proxy["name"] not in [p["name"] for p in proxies]]
+        crashes = [instance["last_crash"] for instance in instances if instance["last_crash"]]
+        return {
+            "event": "state",
+            "running": any(instance["running"] for instance in instances),
+            "enabled": self.enabled,
+            "interfaces": [interface_state(interface) for interface in self.interfaces],
+            "proxies": proxies,
+            "instances": instances,
+            "restarts": sum(instance["restarts"] for instance in instances),
+            "suppressed": sum(instance["suppressed"] for instance in instances),
+            "crashes": sum(instance["crashes"] for instance in instances),
+            "last_crash": max(crashes, key=lambda crash: crash["time"], default=None),
+        }
+
+    def check_mode(self, instance):
+        # There is no front listener on the event loop, every change is applied by restarting in place
+        if instance.mode != "restart":
+            print(f"[{instance.name}] RESTART_MODE {instance.mode} is not supported by the daemon, "
+                  f"restarting in place on port {instance.port or DISPATCH_PORT} (standby ports {instance.standby_ports} unused)")
+
+    async def start_instance(self, instance, available):
+        arguments = instance.prepare(available)
+        self.dispatches[instance.name].crashes.reset()
+        if arguments:
+            await self.dispatches[instance.name].start(arguments)
+
+    async def reconfigure(self, name, changes):
+        """Swap one pool instance's configuration, only that instance's dispatch is restarted"""
+        old, new = self.pool.replace(name, **changes)
+        dispatch = self.dispatches[name]
+        async with dispatch.lock:
+            await dispatch.stop()
+        self.dispatches[name] = AsyncDispatch(new.port)
+        self.check_mode(new)
+        if old.active and self.enabled:
+            await self.start_instance(new, [interface for interface in self.interfaces if interface.last_level == 3])
+
+    def find_interface(self, name):
+        for interface in self.interfaces:
+            if name is not None and interface.name.lower() == name.lower():
+                return interface
+        raise ValueError(f"Unknown interface: {name}")
+
+    async def command(self, command, request):
+        """Runs a control API command, returns the reply"""
+        if command == "ping":
+            return {}
+        if command == "state":
+            return self.state()
+        if command == "history":
+            history = histories.get(self.find_interface(request.get("interface")).name)
+            if "cursor" in request:
+                samples, cursor, dropped = history.read_since(int(request["cursor"]))
+                return {"samples": samples, "cursor": cursor, "dropped": dropped}
+            return history.summary(request.get("window"))
+        if command == "start":
+            self.enabled = True
+            for instance in self.pool.instances:
+                if not self.dispatches[instance.name].is_running():
+                    await self.start_instance(instance, [i for i in self.interfaces if i.last_level == 3])
+        elif command == "stop":
+            self.enabled = False
+            for dispatch in self.dispatches.values():
+                await dispatch.stop()
+        elif command == "reconfigure":
+            await self.reconfigure(request.get("instance"), request.get("changes") or {})
+        elif command == "reprobe":
+            names = request.get("interfaces")
+            self.reprobe(None if names is None else [name.lower() for name in names])
+        else:
+            raise ValueError(f"Unknown command: {command}")
+        self.control.publish_state()
+        return {}
+
+    async def check_health(self):
+        """HealthChecker on the event loop: HEALTH_TARGET through every running dispatch, restart the ones that stopped forwarding"""
+        while not self.stopping.is_set():
+            for instance in self.pool.instances:
+                dispatch = self.dispatches[instance.name]
+                if not self.enabled or not dispatch.is_running() or not instance.available:
+                    continue
+                # Not while it is (re)starting, and a check that overlapped a restart tells nothing
+                if dispatch.lock.locked() or not dispatch.ready.is_set():
+                    continue
+                process = dispatch.process
+                try:
+                    # Blocks for at most HEALTH_TIMEOUT per step, run in a thread like the registered probe backends
+                    result = await asyncio.to_thread(proxy_probe, HEALTH_TARGET, dispatch.port)
+                except OSError as e:
+                    result = e
+                if dispatch.process is not process:
+                    continue
+                restart = instance.record_health(result)
+                if isinstance(result, OSError):
+                    self.wake.set()  # record_health invalidated its uplinks, probe them right away
+                if restart and self.enabled:
+                    print(f"[{instance.name}] dispatch is not forwarding, restarting it")
+                    await dispatch.restart(instance.arguments())
+                self.control.publish_state()
+            try:
+                await asyncio.wait_for(self.stopping.wait(), HEALTH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    def install_signals(self):
+        loop = asyncio.get_running_loop()
+        for name, handler in (("SIGTERM", self.stopping.set), ("SIGINT", self.stopping.set), ("SIGHUP", self.reprobe)):
+            if not hasattr(signal, name):
+                continue
+            try:
+                loop.add_signal_handler(getattr(signal, name), handler)
+            except (NotImplementedError, RuntimeError):
+                signal.signal(getattr(signal, name), lambda *_, handler=handler: loop.call_soon_threadsafe(handler))
+
+    async def run(self):
+        self.semaphore = asyncio.Semaphore(max(1, PROBE_WORKERS))
+        self.wake = asyncio.Event()
+        self.stopping = asyncio.Event()
+        self.install_signals()
+        start_metrics_server()
+        ThroughputProber(self.interfaces).start()
+        watcher = create_watcher()
+        if isinstance(watcher, NetlinkWatcher):
+            self.netlink = watcher
+            watcher.sock.setblocking(False)
+            asyncio.get_running_loop().add_reader(watcher.sock.fileno(), self.on_netlink)
+
+        await self.control.start()
+        await self.refresh_inventory()
+        # Start dispatch with what worked last time, the first cycle confirms it; probe first only without a usable state
+        available = self.state_store.warm_start(self.interfaces, inventory.index)
+        if not available:
+            await self.update_all()
+            available = [interface for interface in self.interfaces if interface.last_level == 3]
+        for instance in self.pool.instances:
+            await self.start_instance(instance, available)
+        if HEALTH_TARGET:
+            asyncio.create_task(self.check_health())
+        sd_notify("READY=1")
+        watchdog = sd_watchdog_interval()
+        last_watchdog = 0
+        cursors = {}
+        try:
+            while not self.stopping.is_set():
+                cycle_start = time.perf_counter()
+                if self.netlink is None:
+                    await self.refresh_inventory()
+                await self.update_all()
+                metrics.observe("monitoring_cycle_seconds", time.perf_counter() - cycle_start)
+                self.state_store.save(self.interfaces)
+                # Only the instances whose own interface group changed are restarted
+                for instance in self.pool.observe(self.interfaces):
+                    if self.enabled and instance in self.pool.instances:  # not replaced by a reconfigure meanwhile
+                        await self.dispatches[instance.name].restart(instance.arguments())
+                for name, dispatch in self.dispatches.items():
+                    lines, cursors[name], dropped = dispatch.read_since(cursors.get(name))
+                    if len(self.dispatches) > 1:
+                        lines = [f"[{name}] {line}" for line in lines]
+                    if lines or dropped:
+                        self.control.publish({"event": "output", "lines": lines, "dropped": dropped})
+                self.control.publish_state()
+                if watchdog and time.time() - last_watchdog >= watchdog:
+                    last_watchdog = time.time()
+                    sd_notify("WATCHDOG=1\nSTATUS=" + ", ".join(f"{i.name}: {i.last_level}" for i in self.interfaces))
+                try:
+                    await asyncio.wait_for(self.wake.wait(), scheduler.wait_time(1))
+                except asyncio.TimeoutError:
+                    pass
+                self.wake.clear()
+        finally:
+            sd_notify("STOPPING=1")
+            await self.control.close()
+            for dispatch in self.dispatches.values():
+                await dispatch.stop()
+
+def sd_notify(state):
+    """Tell systemd (Type=notify) about our state, does nothing outside systemd"""
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address or not hasattr(socket, "AF_UNIX"):
+        return
+    if address.startswith("@"):
+        address = "\0" + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.sendto(state.encode(), address)
+    except OSError as e:
+        print(f"sd_notify failed: {e}")
+
+def sd_watchdog_interval():
+    """Half of systemd's WatchdogSec in seconds, None when the watchdog is off"""
+    usec = os.environ.get("WATCHDOG_USEC")
+    return int(usec) / 2e6 if usec else None
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(Daemon().run())
+    except KeyboardInterrupt:
+        pass
+    sys.exit(0)
@@ -9,6 +9,9 @@ from PIL import Image
 from pystray import MenuItem as item
 from windows_toasts import WindowsToaster, Toast, ToastDisplayImage, ToastImage, ToastImagePosition
 
+# Lines kept in the log pane, the oldest ones are trimmed in bulk once it grows 10% past that
+LOG_MAX_LINES = int(os.environ.get("LOG_MAX_LINES", "5000"))
+
 class DispatchGUI:
     def __init__(self, root):
         self.root = root
@@ -17,8 +20,27 @@ class DispatchGUI:
         
         # Control variables
         self.running = False
-        self.controller = None
+        # dispatch instances (one unless DISPATCH_POOL is set), each with its own supervisor and restart damping
+        self.pool = DispatchPool(on_crash=self.on_crash)
         self.interfaces_objects = [Interface(i) for i in INTERFACES]
+        self.executor = ProbeExecutor()
+        self.watcher = create_watcher()
+        self.watcher.subscribe(self.on_interfaces_changed)
+        self.wake = threading.Event()
+        # When a daemon answers on the control API the GUI only mirrors it, see remote_thread
+        self.client = ControlClient()
+        self.remote = False
+        self.state_store = StateStore()
+        self.warm_available = []
+        self.output_cursor = None
+        self.pending_log = []
+        self.log_lock = threading.Lock()
+        # The monitor publishes (version, rows, proxies), the UI renders only the latest one
+        self.snapshot = (0, (), ())
+        self.rendered_version = 0
+        self.rendered_rows = {}
+        self.rendered_proxies = None
+        self.remote_histories = {}  # history summaries pushed by the daemon
         self.available = []
         self.update_queue = queue.Queue()
         self.tray_icon = None
@@ -67,14 +89,18 @@ class DispatchGUI:
         interfaces_frame.grid(row=1, column=0, sticky=(tk.W, tk.E, tk.N, tk.S), padx=(0, 5))
         
         # Interface list
-        self.interface_tree = ttk.Treeview(interfaces_frame, columns=('level', 'ip'), height=10)
+        self.interface_tree = ttk.Treeview(interfaces_frame, columns=('level', 'ip', 'rtt', 'availability'), height=10)
         self.interface_tree.heading('#0', text='Interface')
         self.interface_tree.heading('level', text='Level')
         self.interface_tree.heading('ip', text='IP Address')
+        self.interface_tree.heading('rtt', text='RTT p50/p95')
+        self.interface_tree.heading('availability', text='Uptime')
         
         self.interface_tree.column('#0', width=150)
         self.interface_tree.column('level', width=80, anchor=tk.CENTER)
         self.interface_tree.column('ip', width=120)
+        self.interface_tree.column('rtt', width=100, anchor=tk.CENTER)
+        self.interface_tree.column('availability', width=70, anchor=tk.CENTER)
         
         scrollbar = ttk.Scrollbar(interfaces_frame, orient=tk.VERTICAL, command=self.interface_tree.yview)
         self.interface_tree.configure(yscrollcommand=scrollbar.set)
@@ -110,11 +136,16 @@ class DispatchGUI:
         main_frame.rowconfigure(1, weight=1)
         main_frame.columnconfigure(1, weight=1)
         
+        # Row colors, configured once
+        self.interface_tree.tag_configure('level3', background='#d4edda')
+        self.interface_tree.tag_configure('level1-2', background='#fff3cd')
+        self.interface_tree.tag_configure('offline', background='#f8d7da')
+        
         # Initialize interface tree
         for interface in self.interfaces_objects:
             self.interface_tree.insert('', 'end', interface.name, 
                                       text=interface.name,
-                                      values=('-', '-'))
+                                      values=('-', '-', '-', '-'))
         
     def setup_tray_icon(self):
         """Setup system tray icon"""
@@ -149,13 +180,32 @@ class DispatchGUI:
             self.tray_button.config(state='disabled', text="Tray Error")
         
     def log_message(self, message):
-        self.log_text.configure(state='normal')
+        """Queue a message for the log pane, it is written on the next UI tick (safe to call from any thread)"""
         timestamp = time.strftime("%H:%M:%S")
-        self.log_text.insert(tk.END, f"[{timestamp}] {message}\n")
-        self.log_text.see(tk.END)
+        with self.log_lock:
+            self.pending_log.append(f"[{timestamp}] {message}\n")
+            
+    def flush_log(self):
+        """Write every queued message with one insert, trimming the oldest lines when over LOG_MAX_LINES"""
+        with self.log_lock:
+            pending, self.pending_log = self.pending_log, []
+        if not pending:
+            return
+        # Only follow the output if the user hasn't scrolled up
+        follow = self.log_text.yview()[1] >= 0.999
+        self.log_text.configure(state='normal')
+        self.log_text.insert(tk.END, "".join(pending))
+        # The text always ends with a newline, so the last line number is one past the message count
+        lines = int(self.log_text.index('end-1c').split('.')[0]) - 1
+        if lines > LOG_MAX_LINES + LOG_MAX_LINES // 10:
+            self.log_text.delete('1.0', f'{lines - LOG_MAX_LINES + 1}.0')
         self.log_text.configure(state='disabled')
+        if follow:
+            self.log_text.see(tk.END)
         
     def clear_log(self):
+        with self.log_lock:
+            self.pending_log = []
         self.log_text.configure(state='normal')
         self.log_text.delete(1.0, tk.END)
         self.log_text.configure(state='disabled')
@@ -167,61 +217,100 @@ class DispatchGUI:
             self.stop_controller()
             
     def start_controller(self):
+        if self.remote:
+            self.send_command("start")
+            return
         try:
-            # Initial update
-            for interface in self.interfaces_objects:
-                interface.update()
-                
-            self.available = []
-            for interface in self.interfaces_objects:
-                if interface.last_level == 3:
-                    self.available.append(interface)
+            # The last known good set restored at launch starts dispatch without waiting for probes, once
+            self.available = [interface for interface in self.warm_available if interface.last_level == 3]
+            self.warm_available = []
+            if not self.available:
+                # Initial update
+                inventory.refresh()
+                self.executor.update_all(self.interfaces_objects)
+                for interface in self.interfaces_objects:
+                    if interface.last_level == 3:
+                        self.available.append(interface)
                     
-            arguments = []
-            for interface in self.available:
-                arguments.append(interface.ip + '/' + str(INTERFACES[interface.name]))
-                
-            if arguments:
-                self.controller = DispatchController(arguments)
+            if self.pool.start(self.available):
+                self.available = self.pool.available
+                self.output_cursor = None
                 self.running = True
                 self.status_label.config(text="Controller: Running", foreground="green")
                 self.control_button.config(text="Stop Controller")
                 self.log_message("Controller started successfully")
                 self.update_proxies_display()
             else:
+                self.pool.stop()
                 self.log_message("No available interfaces at level 3")
                 
         except Exception as e:
             self.log_message(f"Error starting controller: {e}")
             
     def stop_controller(self):
-        if self.controller:
-            self.controller.stop()
+        if self.remote:
+            self.send_command("stop")
+            return
+        self.pool.stop()
         self.running = False
         self.status_label.config(text="Controller: Stopped", foreground="red")
         self.control_button.config(text="Start Controller")
         self.log_message("Controller stopped")
-        self.proxies_label.config(text="No active proxies")
+        self.render_proxies(())
         
+    def send_command(self, command):
+        """Remote mode: ask the daemon, the display follows the state it pushes back"""
+        try:
+            self.client.request(command)
+            self.log_message(f"Sent {command} to the daemon")
+        except (OSError, ValueError, RuntimeError) as e:
+            self.log_message(f"Daemon did not accept {command}: {e}")
+        
+    def publish_snapshot(self):
+        """Called by the monitor each cycle, bumps the version only when something visible changed"""
+        rows = tuple((interface.name, interface.last_level, interface.ip, self.history_text(interface))
+                     for interface in self.interfaces_objects)
+        proxies = tuple((interface.name, interface.ip) for interface in self.available) if self.running else ()
+        version, old_rows, old_proxies = self.snapshot
+        if rows == old_rows and proxies == old_proxies:
+            return
+        self.snapshot = (version + 1, rows, proxies)
+        self.update_queue.put(('interfaces', version + 1))
+        
+    def history_text(self, interface):
+        """(RTT p50/p95, uptime) over HISTORY_WINDOW, as shown in the interface list"""
+        if self.remote:
+            summary = self.remote_histories.get(interface.name)
+        else:
+            summary = interface.history.summary()
+        if not summary:
+            return ('-', '-')
+        rtt = '-' if summary["rtt_p50"] is None else f'{summary["rtt_p50"]:.0f}/{summary["rtt_p95"]:.0f} ms'
+        availability = '-' if summary["availability"] is None else f'{summary["availability"]:.0f}%'
+        return (rtt, availability)
+
     def update_interface_display(self):
-        for interface in self.interfaces_objects:
-            level = interface.last_level
+        """Render the latest snapshot, touching only the rows that changed"""
+        version, rows, proxies = self.snapshot
+        if version <= self.rendered_version:
+            return  # an older message, the latest snapshot is already on screen
+        self.rendered_version = version
+        for name, level, ip, history in rows:
+            if self.rendered_rows.get(name) == (level, ip, history):
+                continue
+            self.rendered_rows[name] = (level, ip, history)
             level_text = str(level) if level >= 0 else "Offline"
-            ip_text = interface.ip if interface.ip else "-"
-            
-            # Update tree item
-            self.interface_tree.item(interface.name, values=(level_text, ip_text))
+            ip_text = ip if ip else "-"
             
             # Color coding
             if level == 3:
-                self.interface_tree.tag_configure('level3', background='#d4edda')
-                self.interface_tree.item(interface.name, tags=('level3',))
+                tag = 'level3'
             elif level >= 0:
-                self.interface_tree.tag_configure('level1-2', background='#fff3cd')
-                self.interface_tree.item(interface.name, tags=('level1-2',))
+                tag = 'level1-2'
             else:
-                self.interface_tree.tag_configure('offline', background='#f8d7da')
-                self.interface_tree.item(interface.name, tags=('offline',))
+                tag = 'offline'
+            self.interface_tree.item(name, values=(level_text, ip_text) + history, tags=(tag,))
+        self.render_proxies(proxies)
     
     def show_toast(self,*args):
         toast_images = [
@@ -246,9 +335,14 @@ class DispatchGUI:
                     self.show_toast(f"{interface.name} upgraded!",f"from {old} to {new}")
     
     def update_proxies_display(self):
-        if self.available:
-            proxies_text = ", ".join([f"{interface.name} ({interface.ip})" 
-                                     for interface in self.available])
+        self.render_proxies(tuple((interface.name, interface.ip) for interface in self.pool.available))
+            
+    def render_proxies(self, proxies):
+        if proxies == self.rendered_proxies:
+            return
+        self.rendered_proxies = proxies
+        if proxies:
+            proxies_text = ", ".join([f"{name} ({ip})" for name, ip in proxies])
             self.proxies_label.config(text=proxies_text)
         else:
             self.proxies_label.config(text="No active proxies")
@@ -258,58 +352,92 @@ class DispatchGUI:
         while True:
             try:
                 
+                cycle_start = time.perf_counter()
                 for interface in self.interfaces_objects:
                     interface.last_last_level = interface.last_level
-                # Update interfaces
-                for interface in self.interfaces_objects:
-                    try:
-                        interface.update()
-                    except Exception as er:
-                        print("Error while updating")
-                        print(traceback.format_exc())
+                # Update interfaces, sharing one `dispatch list` snapshot per cycle (or none with netlink events)
+                self.watcher.poll()
+                self.executor.update_all(self.interfaces_objects)
+                metrics.observe("monitoring_cycle_seconds", time.perf_counter() - cycle_start)
+                self.state_store.save(self.interfaces_objects)
                 # Check for changes
-                new_available = []
-                for interface in self.interfaces_objects:
-                    if interface.last_level == 3:
-                        new_available.append(interface)
-                        
-                if new_available != self.available:
+                if any([i.last_last_level != i.last_level for i in self.interfaces_objects]):
                     self.update_queue.put(('levels_change', None))
-                    self.available = new_available
-                    arguments = []
-                    for interface in self.available:
-                        arguments.append(interface.ip + '/' + str(INTERFACES[interface.name]))
-                        
-                    if self.running and self.controller:
-                        if arguments:
-                            self.controller.restart(arguments)
-                            self.log_message(f"Controller restarted with {len(arguments)} interfaces")
+                # Restarts are damped, so flapping interfaces don't restart dispatch every cycle,
+                # and only the instances whose own interface group changed are restarted
+                for instance in self.pool.observe(self.interfaces_objects):
+                    if self.running:
+                        instance.apply()
+                        if instance.available:
+                            self.log_message(f"Controller {instance.name} restarted with {len(instance.available)} interfaces ({instance.damper.suppressed} restarts suppressed so far)")
                         else:
-                            self.controller.stop()
-                            self.log_message("Controller stopped - no available interfaces")
-                else:
-                    if any([i.last_last_level != i.last_level for i in self.interfaces_objects]):
-                        self.update_queue.put(('levels_change', None))
+                            self.log_message(f"Controller {instance.name} stopped - no available interfaces")
+                self.available = self.pool.available
                     
-                # Update display via queue
-                self.update_queue.put(('interfaces', None))
+                # Update display via queue, only when something changed
+                self.publish_snapshot()
                 
-                # Check controller status
-                if self.running and self.controller:
-                    if not self.controller.is_running():
-                        self.log_message("Controller ended unexpectedly")
-                        self.running = False
-                        self.update_queue.put(('status_stop', None))
-                    else:
-                        output = self.controller.get_output()
-                        if output and output != "No output available":
-                            self.update_queue.put(('log', output))
+                # Crashes are handled by the supervisor, here only lines the log hasn't shown yet
+                if self.running:
+                    lines, self.output_cursor, dropped = self.pool.read_since(self.output_cursor)
+                    if dropped:
+                        self.update_queue.put(('log', f"({dropped} lines of controller output dropped)"))
+                    if lines:
+                        self.update_queue.put(('log', "\n".join(lines)))
                             
-                time.sleep(1)
+                self.wake.wait(scheduler.wait_time(1))
+                self.wake.clear()
                 
             except Exception as e:
                 self.update_queue.put(('log', f"Monitoring error: {e}"))
                 
+    def remote_thread(self):
+        """Thin client mode: mirror what a running daemon pushes instead of probing and running dispatch here"""
+        while True:
+            try:
+                for message in self.client.subscribe():
+                    if message.get("event") == "state":
+                        self.apply_remote_state(message)
+                    elif message.get("event") == "output":
+                        if message["dropped"]:
+                            self.update_queue.put(('log', f"({message['dropped']} lines of controller output dropped)"))
+                        if message["lines"]:
+                            self.update_queue.put(('log', "\n".join(message["lines"])))
+                self.update_queue.put(('log', "Daemon closed the connection, reconnecting"))
+            except (OSError, ValueError) as e:
+                self.update_queue.put(('log', f"Lost the daemon ({e}), reconnecting"))
+            time.sleep(2)
+            
+    def apply_remote_state(self, state):
+        by_name = {interface.name: interface for interface in self.interfaces_objects}
+        for interface in self.interfaces_objects:
+            interface.last_last_level = interface.last_level
+        for entry in state["interfaces"]:
+            interface = by_name.get(entry["name"])
+            if interface:
+                interface.last_level = entry["level"]
+                interface.ip = entry["ip"]
+                self.remote_histories[interface.name] = entry.get("history")
+        if any([i.last_last_level != i.last_level for i in self.interfaces_objects]):
+            self.update_queue.put(('levels_change', None))
+        self.available = [by_name[proxy["name"]] for proxy in state["proxies"] if proxy["name"] in by_name]
+        if state["running"] != self.running:
+            self.running = state["running"]
+            self.update_queue.put(('status_start' if self.running else 'status_stop', None))
+        self.publish_snapshot()
+            
+    def on_crash(self, instance, crash, delay):
+        """Supervisor callback (from its thread) when a dispatch instance exited by itself"""
+        if delay is None:
+            self.log_message(f"Controller {instance.name} keeps crashing (exit code {crash['code']}), giving up")
+            if not self.pool.is_running():
+                self.running = False
+                self.update_queue.put(('status_stop', None))
+        else:
+            self.log_message(f"Controller {instance.name} ended unexpectedly (exit code {crash['code']}), restarting in {delay:g}s")
+        if crash["stderr"]:
+            self.log_message("\n".join(crash["stderr"]))
+            
     def process_queue(self):
         try:
             while True:
@@ -317,11 +445,13 @@ class DispatchGUI:
                 print(msg_type,data)
                 if msg_type == 'interfaces':
                     self.update_interface_display()
-                    self.update_proxies_display()
+                elif msg_type == 'status_start':
+                    self.status_label.config(text="Controller: Running", foreground="green")
+                    self.control_button.config(text="Stop Controller")
                 elif msg_type == 'status_stop':
                     self.status_label.config(text="Controller: Stopped", foreground="red")
                     self.control_button.config(text="Start Controller")
-                    self.proxies_label.config(text="No active proxies")
+                    self.render_proxies(())
                 elif msg_type == 'log':
                     self.log_message(data)
                 elif msg_type == 'levels_change':
@@ -329,10 +459,31 @@ class DispatchGUI:
                     
         except queue.Empty:
             pass
+        self.flush_log()
             
         self.root.after(100, self.process_queue)
         
+    def on_interfaces_changed(self, names):
+        """Interface watcher callback: re-probe the interfaces that changed and wake the monitor up"""
+        changed = [interface for interface in self.interfaces_objects if interface.name.lower() in names]
+        for interface in changed:
+            interface.invalidate()
+        self.executor.update_all(changed)
+        self.wake.set()
+        
     def start_monitoring(self):
+        if self.client.available():
+            self.remote = True
+            self.log_message("Daemon is running, showing its state instead of probing")
+            threading.Thread(target=self.remote_thread, daemon=True).start()
+            self.process_queue()
+            return
+        self.warm_available = self.state_store.warm_start(self.interfaces_objects, inventory.refresh())
+        self.publish_snapshot()
+        start_metrics_server()
+        self.watcher.start()
+        ThroughputProber(self.interfaces_objects).start()
+        HealthChecker(self.pool).start()
         # Start monitoring thread
         monitor_thread = threading.Thread(target=self.monitoring_thread, daemon=True)
         monitor_thread.start()
@@ -392,8 +543,8 @@ class DispatchGUI:
         """Clean exit procedure"""
         if self.tray_icon:
             self.tray_icon.stop()
-        if self.controller:
-            self.controller.stop()
+        self.pool.stop()
+        self.executor.shutdown()
         self.root.destroy()
         
     def on_closing(self):
@@ -6,6 +6,20 @@ import re
 import signal
 import threading
 import traceback
+import socket
+import struct
+import random
+import itertools
+import heapq
+import ssl
+import urllib.parse
+import bisect
+import http.server
+import json
+import math
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
 from dotenv import load_dotenv
 import ast
 
@@ -16,6 +30,104 @@ DISPATCH_EXE = os.environ.get("DISPATCH_EXE", "dispatch.exe")
 INTERFACES = ast.literal_eval(os.environ.get("INTERFACES", "{}"))
 WHITELISTED_URL = os.environ.get("WHITELISTED_URL", "google.com")
 NOT_WHITELISTED_URL = os.environ.get("NOT_WHITELISTED_URL", "youtube.com")
+# How many interfaces are probed at the same time and how long one monitoring cycle may wait for them (seconds)
+PROBE_WORKERS = int(os.environ.get("PROBE_WORKERS", "8"))
+PROBE_DEADLINE = float(os.environ.get("PROBE_DEADLINE", "20"))
+# How long (seconds) one `dispatch list` snapshot is shared before it is taken again
+INVENTORY_TTL = float(os.environ.get("INVENTORY_TTL", "2"))
+# How interface changes are noticed: "auto" (netlink on Linux, polling elsewhere), "netlink" or "poll",
+# and how long a snapshot is kept when netlink events keep it up to date
+INTERFACE_WATCHER = os.environ.get("INTERFACE_WATCHER", "auto").lower()
+WATCHER_INVENTORY_TTL = float(os.environ.get("WATCHER_INVENTORY_TTL", "60"))
+# Port clients connect to, and how interface changes are applied: "restart" stops dispatch and starts it again,
+# "bluegreen" starts the new instance on a standby port behind a front listener and drains the old one
+DISPATCH_HOST = os.environ.get("DISPATCH_HOST", "127.0.0.1")
+DISPATCH_PORT = int(os.environ.get("DISPATCH_PORT", "1080"))
+RESTART_MODE = os.environ.get("RESTART_MODE", "restart").lower()
+DISPATCH_STANDBY_PORTS = ast.literal_eval(os.environ.get("DISPATCH_STANDBY_PORTS", "[1081, 1082]"))
+DRAIN_TIMEOUT = float(os.environ.get("DRAIN_TIMEOUT", "30"))
+# Several dispatch listeners, each with its own port, interface group and restart policy, fed by one probing pass:
+# [{"name": "bulk", "port": 1090, "interfaces": ["Ethernet"]}, {"name": "interactive", "port": 1080, "interfaces": {"Ethernet": 1, "Wi-Fi": 3}}]
+# Empty runs one dispatch with every interface in INTERFACES, as before
+DISPATCH_POOL = ast.literal_eval(os.environ.get("DISPATCH_POOL", "[]"))
+# A started dispatch counts as ready once a line of its output matches DISPATCH_READY_PATTERN or its port accepts connections,
+# it is given up on after DISPATCH_READY_TIMEOUT seconds (or as soon as it exits)
+DISPATCH_READY_PATTERN = os.environ.get("DISPATCH_READY_PATTERN", r"(?i)listening on")
+DISPATCH_READY_TIMEOUT = float(os.environ.get("DISPATCH_READY_TIMEOUT", "10"))
+# When dispatch exits by itself it is restarted after SUPERVISOR_BACKOFF_MIN seconds, doubling up to SUPERVISOR_BACKOFF_MAX
+# for further crashes. After SUPERVISOR_CRASH_LIMIT crashes within SUPERVISOR_CRASH_WINDOW seconds it is left down.
+# The exit code and the last SUPERVISOR_STDERR_LINES lines of stderr are kept for every crash
+SUPERVISOR_BACKOFF_MIN = float(os.environ.get("SUPERVISOR_BACKOFF_MIN", "1"))
+SUPERVISOR_BACKOFF_MAX = float(os.environ.get("SUPERVISOR_BACKOFF_MAX", "60"))
+SUPERVISOR_CRASH_LIMIT = int(os.environ.get("SUPERVISOR_CRASH_LIMIT", "5"))
+SUPERVISOR_CRASH_WINDOW = float(os.environ.get("SUPERVISOR_CRASH_WINDOW", "300"))
+SUPERVISOR_STDERR_LINES = int(os.environ.get("SUPERVISOR_STDERR_LINES", "20"))
+# Restart damping: changes are batched for RESTART_SETTLE seconds, an interface must be seen at level 3 (or not)
+# in RESTART_UP_CONFIRM (RESTART_DOWN_CONFIRM) probe results in a row, and restarts are at least RESTART_MIN_GAP seconds apart
+RESTART_SETTLE = float(os.environ.get("RESTART_SETTLE", "2"))
+RESTART_UP_CONFIRM = int(os.environ.get("RESTART_UP_CONFIRM", "2"))
+RESTART_DOWN_CONFIRM = int(os.environ.get("RESTART_DOWN_CONFIRM", "1"))
+RESTART_MIN_GAP = float(os.environ.get("RESTART_MIN_GAP", "5"))
+# How dispatch priorities are set: "static" (INTERFACES priorities), "quality" (1..WEIGHT_STEPS from smoothed latency
+# and loss), "blend" (INTERFACES priority scaled by quality) or "capacity" (1..WEIGHT_STEPS from measured goodput). Weights only change once they move WEIGHT_HYSTERESIS away
+WEIGHT_MODE = os.environ.get("WEIGHT_MODE", "static").lower()
+WEIGHT_ALPHA = float(os.environ.get("WEIGHT_ALPHA", "0.3"))
+WEIGHT_REFERENCE_RTT = float(os.environ.get("WEIGHT_REFERENCE_RTT", "20"))
+WEIGHT_STEPS = int(os.environ.get("WEIGHT_STEPS", "10"))
+WEIGHT_HYSTERESIS = float(os.environ.get("WEIGHT_HYSTERESIS", "1"))
+# Optional throughput probe: THROUGHPUT_BYTES are downloaded from THROUGHPUT_URL (http or https) over every full access
+# interface each THROUGHPUT_INTERVAL seconds, at most THROUGHPUT_BUDGET bytes per hour. WEIGHT_MODE=capacity uses the results
+THROUGHPUT_URL = os.environ.get("THROUGHPUT_URL", "")
+THROUGHPUT_BYTES = int(os.environ.get("THROUGHPUT_BYTES", "2000000"))
+THROUGHPUT_INTERVAL = float(os.environ.get("THROUGHPUT_INTERVAL", "1800"))
+THROUGHPUT_BUDGET = int(os.environ.get("THROUGHPUT_BUDGET", "50000000"))
+THROUGHPUT_TIMEOUT = float(os.environ.get("THROUGHPUT_TIMEOUT", "15"))
+# End-to-end health check: every HEALTH_INTERVAL seconds HEALTH_TARGET (http or https, disabled when empty) is requested
+# through each running dispatch listener. A check fails on an error or when connecting and the first response byte took
+# longer than HEALTH_MAX_LATENCY seconds (0: no limit), dispatch is restarted after HEALTH_MAX_FAILURES failures in a row
+HEALTH_TARGET = os.environ.get("HEALTH_TARGET", "")
+HEALTH_INTERVAL = float(os.environ.get("HEALTH_INTERVAL", "30"))
+HEALTH_TIMEOUT = float(os.environ.get("HEALTH_TIMEOUT", "5"))
+HEALTH_MAX_LATENCY = float(os.environ.get("HEALTH_MAX_LATENCY", "3"))
+HEALTH_MAX_FAILURES = int(os.environ.get("HEALTH_MAX_FAILURES", "3"))
+# Full probe intervals (seconds): changed or degraded (any probe lost) links are probed every PROBE_INTERVAL_MIN, stable ones
+# back off by PROBE_BACKOFF up to PROBE_INTERVAL_MAX, links without internet up to PROBE_INTERVAL_DOWN_MAX.
+# Between full probes only presence is checked, so PROBE_INTERVAL_MAX bounds how long a lost upstream goes unnoticed.
+# PROBE_INTERVALS overrides min/max per interface: {"Interface Name": [min, max]}
+PROBE_INTERVAL_MIN = float(os.environ.get("PROBE_INTERVAL_MIN", "5"))
+PROBE_INTERVAL_MAX = float(os.environ.get("PROBE_INTERVAL_MAX", "30"))
+PROBE_INTERVAL_DOWN_MAX = float(os.environ.get("PROBE_INTERVAL_DOWN_MAX", "60"))
+PROBE_BACKOFF = float(os.environ.get("PROBE_BACKOFF", "2"))
+PROBE_INTERVALS = ast.literal_eval(os.environ.get("PROBE_INTERVALS", "{}"))
+# Prometheus metrics endpoint (http://METRICS_HOST:METRICS_PORT/metrics), disabled when METRICS_PORT is 0
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+# Local control API (newline-delimited JSON) on CONTROL_HOST:CONTROL_PORT (disabled when 0) and/or the Unix socket
+# CONTROL_SOCKET. Daemon.py serves it, the GUI and the console script follow a running daemon instead of probing themselves
+CONTROL_HOST = os.environ.get("CONTROL_HOST", "127.0.0.1")
+CONTROL_PORT = int(os.environ.get("CONTROL_PORT", "0"))
+CONTROL_SOCKET = os.environ.get("CONTROL_SOCKET", "")
+# Last known state of every interface, saved on every change so dispatch can start right away after a restart (disabled when empty)
+STATE_FILE = os.environ.get("STATE_FILE", "dispatch_state.json")
+# Probe history: the last HISTORY_SAMPLES results of every interface are kept in fixed-size columns, summaries
+# (RTT percentiles, availability, flaps) cover the last HISTORY_WINDOW seconds unless asked otherwise
+HISTORY_SAMPLES = int(os.environ.get("HISTORY_SAMPLES", "1024"))
+HISTORY_WINDOW = float(os.environ.get("HISTORY_WINDOW", "3600"))
+# How many lines of dispatch output are kept per stream
+OUTPUT_BUFFER_LINES = int(os.environ.get("OUTPUT_BUFFER_LINES", "1000"))
+# How connectivity is probed: "native" (ICMP where permitted, TCP connect otherwise), "icmp", "tcp" or "system" (ping.exe)
+PROBE_BACKEND = os.environ.get("PROBE_BACKEND", "native").lower()
+PROBE_TIMEOUT = float(os.environ.get("PROBE_TIMEOUT", "1"))
+PROBE_PORT = int(os.environ.get("PROBE_PORT", "443"))
+# Optional DNS server queried from each interface address, system resolver is used when empty
+DNS_SERVER = os.environ.get("DNS_SERVER", "")
+# How long (seconds) resolved and failed lookups are cached per interface, and how often cached ones are resolved again
+DNS_CACHE_TTL = float(os.environ.get("DNS_CACHE_TTL", "300"))
+DNS_NEGATIVE_TTL = float(os.environ.get("DNS_NEGATIVE_TTL", "10"))
+DNS_REFRESH_INTERVAL = float(os.environ.get("DNS_REFRESH_INTERVAL", "30"))
+# Probes stop at the first reply or after PROBE_MAX_FAILURES losses in a row, unless full statistics are requested
+PROBE_MAX_FAILURES = int(os.environ.get("PROBE_MAX_FAILURES", "2"))
+PROBE_FULL_STATS = os.environ.get("PROBE_FULL_STATS", "0").lower() in ("1", "true", "yes")
 
 def execute_cmd(cmd_command):
     # Run the command and capture its output
@@ -26,10 +138,146 @@ def execute_cmd(cmd_command):
         output = e.output
         # Handle the error if the command execution fails
     return output
+class Metrics:
+    """Counters, gauges and histograms exposed in Prometheus text format.
+    Each thread records into its own shard so samples never wait on a lock, scrapes merge the shards"""
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self.meta = {}    # name -> (type, help, buckets)
+        self.shards = []
+        self.gauges = {}  # gauges are only ever overwritten, a plain dict is enough
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.collectors = []  # called with the Metrics object before every scrape, to set gauges computed on demand
+
+    def register(self, kind, name, help, buckets=None):
+        self.meta[name] = (kind, help, tuple(buckets or self.DEFAULT_BUCKETS) if kind == "histogram" else None)
+
+    def _shard(self):
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = self.local.shard = {}
+            with self.lock:  # once per thread
+                self.shards.append(shard)
+        return shard
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        shard = self._shard()
+        shard[key] = shard.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        shard = self._shard()
+        buckets = self.meta[name][2]
+        entry = shard.get(key)
+        if entry is None:
+            entry = shard[key] = [0] * (len(buckets) + 1) + [0.0]  # per bucket counts, +Inf, sum
+        entry[bisect.bisect_left(buckets, value)] += 1
+        entry[-1] += value
+
+    def set(self, name, value, **labels):
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def collect(self):
+        """Merged {(name, labels): value} of every shard"""
+        with self.lock:
+            shards = [shard.copy() for shard in self.shards]
+        merged = dict(self.gauges)
+        for shard in shards:
+            for key, value in shard.items():
+                if isinstance(value, list):
+                    total = merged.setdefault(key, [0] * len(value))
+                    for index, item in enumerate(value):
+                        total[index] += item
+                else:
+                    merged[key] = merged.get(key, 0) + value
+        return merged
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        labels = tuple(labels) + tuple(extra)
+        if not labels:
+            return ""
+        escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in labels) + "}"
+
+    def render(self):
+        for collector in self.collectors:
+            collector(self)
+        merged = self.collect()
+        lines = []
+        for name, (kind, help, buckets) in sorted(self.meta.items()):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (sample, labels), value in sorted(merged.items(), key=lambda item: str(item[0])):
+                if sample != name:
+                    continue
+                if kind != "histogram":
+                    lines.append(f"{name}{self._labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + ("+Inf",), value):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_sum{self._labels(labels)} {value[-1]}")
+                lines.append(f"{name}_count{self._labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.register("histogram", "probe_duration_seconds", "Duration of connectivity probes by interface and probe type")
+metrics.register("gauge", "interface_level", "Current connectivity level of the interface (-1..3)")
+metrics.register("counter", "level_transitions_total", "Connectivity level changes by interface")
+metrics.register("counter", "interface_level_seconds_total", "Time the interface spent at each connectivity level")
+metrics.register("counter", "dispatch_restarts_total", "dispatch restarts")
+metrics.register("counter", "dispatch_restart_downtime_seconds_total", "Time dispatch spent without a listener during restarts")
+metrics.register("counter", "dispatch_list_invocations_total", "`dispatch list` runs")
+metrics.register("counter", "dispatch_crashes_total", "Times dispatch exited without being stopped")
+metrics.register("histogram", "monitoring_cycle_seconds", "Duration of one monitoring cycle")
+metrics.register("histogram", "health_connect_seconds", "Time to connect to HEALTH_TARGET through dispatch")
+metrics.register("histogram", "health_ttfb_seconds", "Time from sending the health check request through dispatch to the first response byte")
+metrics.register("counter", "health_checks_total", "End-to-end health checks through dispatch by result (ok, slow, failed)")
+metrics.register("counter", "health_restarts_total", "dispatch restarts because it failed its health checks")
+metrics.register("gauge", "interface_rtt_p50_milliseconds", "Median probe RTT of the interface over HISTORY_WINDOW")
+metrics.register("gauge", "interface_rtt_p95_milliseconds", "95th percentile probe RTT of the interface over HISTORY_WINDOW")
+metrics.register("gauge", "interface_availability_ratio", "Share of HISTORY_WINDOW the interface spent at full access")
+metrics.register("gauge", "interface_flaps", "Level changes of the interface over HISTORY_WINDOW")
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(port=None, host=None):
+    """Serve /metrics on METRICS_HOST:METRICS_PORT (disabled when the port is 0)"""
+    port = METRICS_PORT if port is None else port
+    if not port:
+        return None
+    server = http.server.ThreadingHTTPServer((host or METRICS_HOST, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Metrics available at http://{host or METRICS_HOST}:{server.server_port}/metrics")
+    return server
+
 def interface_list():
+    metrics.inc("dispatch_list_invocations_total")
     text = subprocess.run([DISPATCH_EXE, "list"], capture_output=True, text=True)
+    return parse_interface_list(text.stdout)
+
+def parse_interface_list(text):
     # Remove ANSI codes
-    text = re.sub(r'\x1b\[[0-9;]*m', '', text.stdout)
+    text = re.sub(r'\x1b\[[0-9;]*m', '', text)
     
     # Split by horizontal dividers to get sections
     sections = re.split(r'╠═══════════════════════════════════╬════════════════════════════════════════╣', text)
@@ -61,7 +309,328 @@ def interface_list():
     
     return interfaces
 
-def ping(adr, interface, n=4):
+def _family(interface):
+    return socket.AF_INET6 if interface and ':' in interface else socket.AF_INET
+
+def _dns_query(adr, interface, family):
+    """Ask DNS_SERVER for adr from the interface address, returns a list of addresses or None"""
+    qtype = 28 if family == socket.AF_INET6 else 1
+    query_id = random.getrandbits(16)
+    question = b''.join(bytes([len(label)]) + label.encode('idna') for label in adr.rstrip('.').split('.')) + b'\0'
+    packet = struct.pack('!HHHHHH', query_id, 0x0100, 1, 0, 0, 0) + question + struct.pack('!HH', qtype, 1)
+    with socket.socket(family, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(PROBE_TIMEOUT)
+        if interface:
+            sock.bind((interface, 0))
+        try:
+            sock.sendto(packet, (DNS_SERVER, 53))
+            while True:
+                data = sock.recv(4096)
+                if len(data) >= 12 and struct.unpack('!H', data[:2])[0] == query_id:
+                    break
+        except OSError:
+            return None
+    _, flags, qdcount, ancount, _, _ = struct.unpack('!HHHHHH', data[:12])
+    if flags & 0x000f:  # NXDOMAIN, SERVFAIL...
+        return None
+
+    def skip_name(offset):
+        while data[offset]:
+            if data[offset] & 0xc0 == 0xc0:  # compression pointer ends the name
+                return offset + 2
+            offset += data[offset] + 1
+        return offset + 1
+
+    offset = 12
+    for _ in range(qdcount):
+        offset = skip_name(offset) + 4
+    addresses = []
+    for _ in range(ancount):
+        offset = skip_name(offset)
+        rtype, _, _, length = struct.unpack('!HHIH', data[offset:offset + 10])
+        offset += 10
+        if rtype == qtype:
+            addresses.append(socket.inet_ntop(family, data[offset:offset + length]))
+        offset += length
+    return addresses or None
+
+def query_dns(adr, interface):
+    """Resolve adr into addresses of the interface's address family, returns None if it can't be resolved"""
+    family = _family(interface)
+    if DNS_SERVER and _family(DNS_SERVER) == family:
+        return _dns_query(adr, interface, family)
+    try:
+        infos = socket.getaddrinfo(adr, None, family, socket.SOCK_STREAM)
+    except OSError:
+        return None
+    return list(dict.fromkeys(info[4][0] for info in infos)) or None
+
+class DnsCache:
+    """Resolved addresses keyed by (interface, hostname), kept fresh by a background refresh"""
+    def __init__(self, ttl=DNS_CACHE_TTL, negative_ttl=DNS_NEGATIVE_TTL, refresh_interval=DNS_REFRESH_INTERVAL, resolver=query_dns):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.refresh_interval = refresh_interval
+        self.resolver = resolver
+        self.entries = {}  # (interface, hostname) -> (addresses, resolved at, last used)
+        self.lock = threading.Lock()
+        self.refresher = None
+
+    def _fresh(self, entry, now):
+        ttl = self.ttl if entry[0] else self.negative_ttl
+        return now - entry[1] < ttl
+
+    def peek(self, adr, interface):
+        """(True, addresses) on a cache hit, (False, None) when adr has to be resolved"""
+        key = (interface, adr.lower())
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry and self._fresh(entry, now):
+            self.entries[key] = (entry[0], entry[1], now)
+            return True, entry[0]
+        return False, None
+
+    def lookup(self, adr, interface):
+        """Cached addresses of adr as resolved from the interface, resolving on a miss"""
+        hit, addresses = self.peek(adr, interface)
+        if hit:
+            return addresses
+        self.start()
+        return self.resolve(adr, interface)
+
+    def resolve(self, adr, interface):
+        """Resolve right away and cache the result, failures included (they are the level 1 signal)"""
+        addresses = self.resolver(adr, interface)
+        now = time.time()
+        key = (interface, adr.lower())
+        with self.lock:
+            entry = self.entries.get(key)
+            self.entries[key] = (addresses, now, entry[2] if entry else now)
+        return addresses
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            now = time.time()
+            with self.lock:
+                # Entries nobody looked up for a whole ttl are evicted instead of refreshed
+                for key in [key for key, entry in self.entries.items() if now - entry[2] >= self.ttl]:
+                    del self.entries[key]
+                keys = list(self.entries)
+            for interface, adr in keys:
+                try:
+                    self.resolve(adr, interface)
+                except Exception as e:
+                    print(f"DNS refresh of {adr} from {interface} failed: {e}")
+
+    def start(self):
+        if self.refresher is None and self.refresh_interval > 0:
+            self.refresher = threading.Thread(target=self._refresh_loop, daemon=True)
+            self.refresher.start()
+
+dns_cache = DnsCache()
+
+def resolve(adr, interface):
+    """Resolve adr into addresses of the interface's address family through the DNS cache, None if it can't be resolved"""
+    return dns_cache.lookup(adr, interface)
+
+def _checksum(data):
+    if len(data) % 2:
+        data += b'\0'
+    total = sum(struct.unpack(f'!{len(data) // 2}H', data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+_icmp_kinds = {}
+
+def _icmp_socket(family):
+    """Open an ICMP socket, unprivileged (datagram) if the system allows it, raw otherwise. None if neither is permitted"""
+    proto = socket.IPPROTO_ICMPV6 if family == socket.AF_INET6 else socket.IPPROTO_ICMP
+    kinds = [_icmp_kinds[family]] if family in _icmp_kinds else [socket.SOCK_DGRAM, socket.SOCK_RAW]
+    for kind in kinds:
+        if kind is None:
+            continue
+        try:
+            sock = socket.socket(family, kind, proto)
+            _icmp_kinds[family] = kind
+            return sock
+        except OSError:
+            pass
+    _icmp_kinds[family] = None
+    return None
+
+# Raw ICMP sockets receive every echo reply on the host, so each echo request gets its own sequence number
+# and concurrent probes can't take each other's replies
+_icmp_sequence = itertools.count(random.randrange(0x10000))
+
+def icmp_echo_packet(family, target, seq=None):
+    """Echo request packet and the (reply type, identifier, sequence, target) to match the answer against"""
+    request, reply = (128, 129) if family == socket.AF_INET6 else (8, 0)
+    ident = os.getpid() & 0xffff
+    seq = (next(_icmp_sequence) if seq is None else seq) & 0xffff
+    payload = b'dispatch-proxy-manager'
+    header = struct.pack('!BBHHH', request, 0, 0, ident, seq)
+    packet = struct.pack('!BBHHH', request, 0, _checksum(header + payload), ident, seq) + payload
+    return packet, (reply, ident, seq, target)
+
+def _same_address(address, other):
+    family = _family(other)
+    try:
+        return socket.inet_pton(family, address.split('%')[0]) == socket.inet_pton(family, other)
+    except OSError:
+        return False
+
+def icmp_is_reply(sock, data, expected, source=None):
+    """Whether data is the answer to the echo request. source is where it came from, None on a socket connected to the target"""
+    reply, ident, seq, target = expected
+    if source is not None and not _same_address(source, target):
+        return False
+    if sock.family == socket.AF_INET and data and data[0] >> 4 == 4:
+        data = data[(data[0] & 0x0f) * 4:]  # raw IPv4 sockets deliver the IP header too
+    if len(data) < 8 or data[0] != reply:
+        return False
+    # Datagram sockets get their identifier rewritten by the kernel, so only the sequence is compared
+    r_ident, r_seq = struct.unpack('!HH', data[4:8])
+    return r_seq == seq and (sock.type == socket.SOCK_DGRAM or r_ident == ident)
+
+def icmp_probe(target, interface, seq=None, timeout=None):
+    """Send one ICMP echo to target from the interface address. Returns the RTT in ms, None if no reply came.
+    Raises PermissionError if this system doesn't allow ICMP sockets"""
+    timeout = PROBE_TIMEOUT if timeout is None else timeout
+    family = _family(target)
+    sock = _icmp_socket(family)
+    if sock is None:
+        raise PermissionError("ICMP sockets are not permitted")
+    packet, expected = icmp_echo_packet(family, target, seq)
+    with sock:
+        if interface:
+            sock.bind((interface, 0))
+        start = time.perf_counter()
+        try:
+            sock.sendto(packet, (target, 0))
+            while True:
+                left = timeout - (time.perf_counter() - start)
+                if left <= 0:
+                    return None
+                sock.settimeout(left)
+                data, source = sock.recvfrom(2048)
+                if icmp_is_reply(sock, data, expected, source[0]):
+                    return (time.perf_counter() - start) * 1000
+        except OSError:
+            return None
+
+def tcp_probe(target, interface, port=None, timeout=None):
+    """Open a TCP connection to target from the interface address. Returns the connect time in ms, None if it failed"""
+    with socket.socket(_family(target), socket.SOCK_STREAM) as sock:
+        sock.settimeout(PROBE_TIMEOUT if timeout is None else timeout)
+        try:
+            if interface:
+                sock.bind((interface, 0))
+            start = time.perf_counter()
+            sock.connect((target, PROBE_PORT if port is None else port))
+            return (time.perf_counter() - start) * 1000
+        except OSError:
+            return None
+
+def probe_stream(target, interface, n=4, method=None):
+    """Yield the RTT in ms (None when lost) of each of n probes as soon as it completes"""
+    method = method or PROBE_BACKEND
+    for _ in range(n):
+        rtt = None
+        if method in ("native", "icmp"):
+            try:
+                rtt = icmp_probe(target, interface)
+            except PermissionError:
+                if method == "icmp":
+                    raise
+                method = "tcp"
+        if method == "tcp":
+            rtt = tcp_probe(target, interface)
+        yield rtt
+
+def _stream_decided(rtt, failures, full_stats, max_failures):
+    """Whether a streaming probe can stop: one reply or max_failures losses in a row decide the level"""
+    if full_stats:
+        return False
+    return rtt is not None or failures >= max_failures
+
+class PingTally:
+    """The RTTs (None when lost) of one streaming probe: when it can stop, and its (dns, packets, pings) result.
+    Shared by native_ping and the daemon's async_ping"""
+    def __init__(self, full_stats=None, max_failures=None):
+        self.full_stats = PROBE_FULL_STATS if full_stats is None else full_stats
+        self.max_failures = PROBE_MAX_FAILURES if max_failures is None else max_failures
+        self.results = []
+        self.failures = 0
+
+    def add(self, rtt):
+        """Returns whether the probe is decided and can stop"""
+        self.results.append(rtt)
+        self.failures = 0 if rtt is not None else self.failures + 1
+        return _stream_decided(rtt, self.failures, self.full_stats, self.max_failures)
+
+    def result(self):
+        rtts = [rtt for rtt in self.results if rtt is not None]
+        sent, retrieved = len(self.results), len(rtts)
+        loss = round(100 * (sent - retrieved) / sent) if sent else None
+        if not rtts:
+            return True,(sent,retrieved,loss),(None,None,None)
+        return True,(sent,retrieved,loss),(round(min(rtts), 2),round(sum(rtts) / retrieved, 2),round(max(rtts), 2))
+
+def native_ping(adr, interface, n=4, method=None, full_stats=None, max_failures=None):
+    """In-process replacement of `ping`, same result shape, no subprocess and no dependency on system language.
+    Unless full_stats is set it stops at the first reply or after max_failures consecutive losses"""
+    addresses = resolve(adr, interface)
+    if not addresses:
+        return False,(None,None,None),(None,None,None)
+    tally = PingTally(full_stats, max_failures)
+    for rtt in probe_stream(addresses[0], interface, n, method):
+        if tally.add(rtt):
+            break
+    return tally.result()
+
+def system_ping_stream(adr, interface, n=4, max_failures=None):
+    """Run ping.exe reading its output line by line, killing it at the first reply or after max_failures losses"""
+    max_failures = PROBE_MAX_FAILURES if max_failures is None else max_failures
+    print("Running internet subprocess...")
+    process = subprocess.Popen(['ping', adr, '-S', str(interface), '-n', str(n)],
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, errors="ignore")
+    dns, rtts, sent, failures = None, [], 0, 0
+    header = None
+    try:
+        for line in process.stdout:
+            line = line.strip()
+            if header is None:
+                if line:
+                    # "Pinging host [address] ...": the resolved address is in brackets in every language
+                    header = line
+                    dns = '[' in line
+                continue
+            if not line:
+                break  # statistics follow the echo lines
+            sent += 1
+            # Every echo reply carries TTL=, whatever the system language is
+            rtt = None
+            if 'ttl=' in line.lower():
+                match = re.search(r'[=<]\s*(\d+)\s*ms', line)
+                rtt = int(match.group(1)) if match else 0
+                rtts.append(rtt)
+            failures = 0 if rtt is not None else failures + 1
+            if _stream_decided(rtt, failures, False, max_failures):
+                break
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+    if not sent:
+        return dns,(None,None,None),(None,None,None)
+    loss = round(100 * (sent - len(rtts)) / sent)
+    if not rtts:
+        return dns,(sent,0,loss),(None,None,None)
+    return dns,(sent,len(rtts),loss),(min(rtts),round(sum(rtts) / len(rtts)),max(rtts))
+
+def system_ping(adr, interface, n=4):
     print("Running internet subprocess...")
     ping_result = execute_cmd(f'ping {adr} -S {interface} -n {n}')
     max_ping,avg_ping,min_ping,dns,sent,retrieved,loss = None,None,None,None,None,None,None
@@ -103,6 +672,156 @@ def ping(adr, interface, n=4):
                     value = ""
     return dns,(sent,retrieved,loss),(min_ping,avg_ping,max_ping)
 
+# Extra probe backends selectable with PROBE_BACKEND, name -> function(adr, interface, n, full_stats)
+probe_backends = {}
+
+def register_probe_backend(name, function):
+    probe_backends[name.lower()] = function
+
+def ping(adr, interface, n=4, full_stats=None):
+    full_stats = PROBE_FULL_STATS if full_stats is None else full_stats
+    if PROBE_BACKEND in probe_backends:
+        return probe_backends[PROBE_BACKEND](adr, interface, n, full_stats)
+    if PROBE_BACKEND == "system":
+        if full_stats:
+            return system_ping(adr, interface, n)
+        return system_ping_stream(adr, interface, n)
+    return native_ping(adr, interface, n, full_stats=full_stats)
+
+class InterfaceInventory:
+    """Shared snapshot of `dispatch list`, indexed by lowercase interface name"""
+    def __init__(self, ttl=INVENTORY_TTL, source=interface_list):
+        self.ttl = ttl
+        self.source = source
+        self.index = {}
+        self.version = 0
+        self.taken = 0
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """Take a new snapshot right away"""
+        return self.snapshot(force=True)
+
+    def snapshot(self, force=False):
+        """Return {lowercase name: (name, [addresses])}, taking a new one only when the current one is older than ttl"""
+        with self.lock:
+            # Callers waiting on the lock reuse the snapshot the first one took
+            if force or time.time() - self.taken >= self.ttl:
+                try:
+                    interfaces = self.source()
+                except Exception as e:
+                    print(f"Failed to list interfaces: {e}")
+                    return self.index
+                self._store(interfaces)
+            return self.index
+
+    def store(self, interfaces):
+        """Take a snapshot listed by someone else (the daemon lists interfaces asynchronously)"""
+        with self.lock:
+            return self._store(interfaces)
+
+    def _store(self, interfaces):
+        index = {name.lower(): (name, ips) for name, ips in interfaces.items()}
+        if index != self.index:
+            self.version += 1
+        self.index = index
+        self.taken = time.time()
+        return index
+
+    def lookup(self, name):
+        """Return addresses of the interface (case-insensitive) or None if it is not present"""
+        entry = self.snapshot().get(name.lower())
+        return entry[1] if entry else None
+
+inventory = InterfaceInventory()
+
+class InterfaceWatcher:
+    """Tells subscribers which interfaces appeared, disappeared or changed addresses"""
+    event_driven = False
+    def __init__(self, inventory=inventory):
+        self.inventory = inventory
+        self.subscribers = []
+        self.known = {}
+
+    def subscribe(self, callback):
+        """callback(names) gets the lowercase names of the interfaces that changed"""
+        self.subscribers.append(callback)
+
+    def check(self):
+        """Take a fresh `dispatch list` snapshot and notify subscribers about what differs from the previous one"""
+        index = self.inventory.refresh()
+        changed = [name for name in set(index) | set(self.known) if index.get(name) != self.known.get(name)]
+        self.known = index
+        if changed:
+            for callback in self.subscribers:
+                try:
+                    callback(changed)
+                except Exception:
+                    print(traceback.format_exc())
+        return changed
+
+    def start(self):
+        pass
+
+    def poll(self):
+        """Called once per monitoring cycle"""
+        pass
+
+class PollingWatcher(InterfaceWatcher):
+    """Fallback: compares `dispatch list` snapshots once per monitoring cycle"""
+    def poll(self):
+        self.check()
+
+class NetlinkWatcher(InterfaceWatcher):
+    """Linux: wakes up on rtnetlink link and address events, so nothing is polled while interfaces stay the same"""
+    event_driven = True
+    RTMGRP_LINK = 0x1
+    RTMGRP_IPV4_IFADDR = 0x10
+    RTMGRP_IPV6_IFADDR = 0x100
+
+    def __init__(self, inventory=inventory, settle=0.05):
+        super().__init__(inventory)
+        self.settle = settle
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        self.sock.bind((0, self.RTMGRP_LINK | self.RTMGRP_IPV4_IFADDR | self.RTMGRP_IPV6_IFADDR))
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            # Events keep the snapshot current, the ttl is only a safety net now
+            self.inventory.ttl = WATCHER_INVENTORY_TTL
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def run(self):
+        self.check()
+        while True:
+            try:
+                self.sock.recv(65536)
+                # Events come in bursts (link, then every address), take them all before listing interfaces
+                self.sock.settimeout(self.settle)
+                try:
+                    while True:
+                        self.sock.recv(65536)
+                except socket.timeout:
+                    pass
+                finally:
+                    self.sock.settimeout(None)
+                self.check()
+            except OSError as e:
+                print(f"Netlink watcher failed: {e}")
+                time.sleep(1)
+
+def create_watcher(inventory=inventory, kind=None):
+    """Netlink watcher where it is available (Linux), polling everywhere else"""
+    kind = kind or INTERFACE_WATCHER
+    if kind in ("auto", "netlink") and hasattr(socket, "AF_NETLINK"):
+        try:
+            return NetlinkWatcher(inventory)
+        except OSError as e:
+            print(f"Netlink is not available ({e}), polling for interface changes")
+    return PollingWatcher(inventory)
+
 class Element(object):
     def __init__(self,color:str='green', text:str="Test"):
         if not color in "green,red,gray,blue,orange":
@@ -115,9 +834,299 @@ class Element(object):
             t = t[:17]+"..."
         return f"<text:'{t}'color:{self.color}>"
 
+def _replied(result):
+    return result is not None and result[2][1] is not None
+
+# Which probes each level decision needs, and how the level is decided from their results
+LEVEL_PROBES = {1: ('whitelisted',), 2: ('whitelisted',), 3: ('full',)}
+LEVEL_CHECKS = {
+    1: lambda results: bool(results.get('whitelisted') and results['whitelisted'][0]) or _replied(results.get('whitelisted')),
+    2: lambda results: _replied(results.get('whitelisted')),
+    3: lambda results: _replied(results.get('full')),
+}
+
+def decide_level(level, passed):
+    """Climb from the current level while the next one passes, otherwise step down until one passes"""
+    if passed(level):
+        if level == -1:
+            level = 0
+        while level < 3 and passed(level + 1):
+            level += 1
+    else:
+        while level > 0:
+            level -= 1
+            if passed(level):
+                break
+    return level
+
+class ProbePlanner:
+    """Runs every distinct probe a level decision needs once, all of them at the same time"""
+    def __init__(self, max_workers=PROBE_WORKERS * 2):
+        self.pool = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="planner")
+
+    def probe_targets(self):
+        return {'whitelisted': WHITELISTED_URL, 'full': NOT_WHITELISTED_URL}
+
+    def plan(self, levels=(1, 2, 3)):
+        probes = []
+        for level in levels:
+            for probe in LEVEL_PROBES.get(level, ()):
+                if probe not in probes:
+                    probes.append(probe)
+        return probes
+
+    def stages(self, level):
+        """Probes a decision from `level` needs, in stages: a later stage only runs when the earlier ones didn't settle it.
+        A full access link only needs the full probe while it keeps passing, climbing needs every probe at once"""
+        if level >= 3:
+            return [self.plan([3]), self.plan([1, 2])]
+        return [self.plan()]
+
+    def settled(self, level, results):
+        return level >= 3 and LEVEL_CHECKS[3](results)
+
+    def probe(self, interface, level):
+        """Results of the stages for a decision from `level`, {probe: (dns, packets, pings)}"""
+        results = {}
+        for probes in self.stages(level):
+            results.update(self.run(interface, probes))
+            if self.settled(level, results):
+                break
+        return results
+
+    def run(self, interface, probes):
+        """Returns {probe: (dns, packets, pings)}"""
+        targets = self.probe_targets()
+        futures = {probe: self.pool.submit(self._timed_ping, interface, probe, targets[probe]) for probe in probes}
+        return {probe: future.result() for probe, future in futures.items()}
+
+    def _timed_ping(self, interface, probe, target):
+        start = time.perf_counter()
+        try:
+            return ping(target, interface.ip)
+        finally:
+            metrics.observe("probe_duration_seconds", time.perf_counter() - start, interface=interface.name, probe=probe)
+
+planner = ProbePlanner()
+
+class ProbeScheduler:
+    """Gives every interface its own next full probe deadline, kept in a priority queue.
+    Links that just changed, are degraded or lost a probe are probed every `min` seconds, stable ones back off toward `max`,
+    links without internet back off exponentially toward PROBE_INTERVAL_DOWN_MAX"""
+    def __init__(self, interval_min=PROBE_INTERVAL_MIN, interval_max=PROBE_INTERVAL_MAX,
+                 down_max=PROBE_INTERVAL_DOWN_MAX, backoff=PROBE_BACKOFF, overrides=PROBE_INTERVALS):
+        self.interval_min = interval_min
+        self.interval_max = interval_max
+        self.down_max = down_max
+        self.backoff = backoff
+        self.overrides = {name.lower(): limits for name, limits in overrides.items()}
+        self.heap = []       # (deadline, sequence, interface), may hold outdated entries
+        self.deadlines = {}  # interface -> current deadline
+        self.intervals = {}  # interface -> current interval
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def limits(self, interface):
+        return self.overrides.get(interface.name.lower(), (self.interval_min, self.interval_max))
+
+    def _push(self, interface, deadline):
+        self.deadlines[interface] = deadline
+        heapq.heappush(self.heap, (deadline, next(self.counter), interface))
+
+    def due(self, interface, now=None):
+        return (now or time.time()) >= self.deadlines.get(interface, 0)
+
+    def reschedule(self, interface, old_level, new_level, lossy=False):
+        """Called after every full probe (lossy: some of its probes were lost), returns the interval until the next one"""
+        low, high = self.limits(interface)
+        with self.lock:
+            interval = self.intervals.get(interface, low)
+            if new_level != old_level or 0 < new_level < 3 or (new_level == 3 and lossy):
+                interval = low
+            elif new_level <= 0:
+                interval = min(max(interval, low) * self.backoff, max(self.down_max, low))
+            else:
+                interval = min(interval * self.backoff, high)
+            self.intervals[interface] = interval
+            self._push(interface, time.time() + interval)
+        return interval
+
+    def invalidate(self, interface):
+        with self.lock:
+            self.intervals.pop(interface, None)
+            self._push(interface, 0)
+
+    def next_deadline(self):
+        """Earliest deadline of any interface, None when nothing is scheduled"""
+        with self.lock:
+            while self.heap and self.deadlines.get(self.heap[0][2]) != self.heap[0][0]:
+                heapq.heappop(self.heap)  # superseded by a later reschedule
+            return self.heap[0][0] if self.heap else None
+
+    def wait_time(self, ceiling):
+        """How long the monitor can sleep before the next probe is due, at most ceiling"""
+        deadline = self.next_deadline()
+        if deadline is None:
+            return ceiling
+        return min(ceiling, max(0, deadline - time.time()))
+
+scheduler = ProbeScheduler()
+
+class QualityTracker:
+    """Smoothed (EWMA) latency and loss of one interface"""
+    def __init__(self, alpha=WEIGHT_ALPHA):
+        self.alpha = alpha
+        self.rtt = None
+        self.loss = None
+
+    def add(self, result):
+        """Feed one probe result (dns, packets, pings)"""
+        dns, packets, pings = result
+        sent, retrieved, loss = packets
+        loss = 1.0 if loss is None else loss / 100
+        self.loss = loss if self.loss is None else self.loss + self.alpha * (loss - self.loss)
+        if pings[1] is not None:
+            self.rtt = pings[1] if self.rtt is None else self.rtt + self.alpha * (pings[1] - self.rtt)
+
+    def score(self):
+        """1 for a lossless link at or below WEIGHT_REFERENCE_RTT, lower for slower or lossier ones"""
+        if self.rtt is None:
+            return 0.0 if self.loss else 1.0
+        return min(1.0, WEIGHT_REFERENCE_RTT / max(self.rtt, 0.001)) * (1 - (self.loss or 0))
+
+def _percentile(ordered, fraction):
+    """Nearest-rank percentile of sorted values: the smallest one with at least `fraction` of the values at or below it"""
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)] if ordered else None
+
+class ProbeHistory:
+    """The last `capacity` probe results of one interface in fixed-size array columns: time, level, RTT (ms) and loss (0..1).
+    Appending overwrites the oldest sample, queries walk back from the newest one and only visit the window they ask for"""
+    def __init__(self, capacity=HISTORY_SAMPLES):
+        self.capacity = max(1, capacity)
+        self.times = array('d', [0.0]) * self.capacity
+        self.levels = array('b', [-1]) * self.capacity
+        self.rtts = array('f', [math.nan]) * self.capacity
+        self.losses = array('f', [math.nan]) * self.capacity
+        self.seq = 0  # samples appended so far, the cursor after the newest one
+        self.lock = threading.Lock()
+
+    def append(self, level, rtt=None, loss=None, timestamp=None):
+        with self.lock:
+            slot = self.seq % self.capacity
+            self.times[slot] = time.time() if timestamp is None else timestamp
+            self.levels[slot] = level
+            self.rtts[slot] = math.nan if rtt is None else rtt
+            self.losses[slot] = math.nan if loss is None else loss
+            self.seq += 1
+
+    def _row(self, slot):
+        rtt, loss = self.rtts[slot], self.losses[slot]
+        return (self.times[slot], self.levels[slot], None if math.isnan(rtt) else rtt, None if math.isnan(loss) else loss)
+
+    def read_since(self, cursor=0):
+        """Returns ([(time, level, rtt, loss)] appended after cursor, new cursor, samples dropped before the reader got to them)"""
+        with self.lock:
+            first = self.seq - min(self.seq, self.capacity)
+            if cursor > self.seq:  # cursor of an older history, start over
+                cursor = 0
+            start = max(cursor, first)
+            return [self._row(seq % self.capacity) for seq in range(start, self.seq)], self.seq, start - cursor
+
+    def _slices(self, start):
+        """Slot ranges holding samples start..seq-1 in order, at most two since the columns wrap around"""
+        first, last = start % self.capacity, self.seq % self.capacity or self.capacity
+        if start >= self.seq:
+            return []
+        if first < last:
+            return [(first, last)]
+        return [(first, self.capacity), (0, last)]
+
+    def _column(self, column, slices):
+        return list(itertools.chain.from_iterable(column[first:last] for first, last in slices))
+
+    def summary(self, window=None, now=None):
+        """RTT percentiles, mean loss, availability (% of the time at full access) and level changes over the last `window` seconds"""
+        window = HISTORY_WINDOW if window is None else window
+        now = time.time() if now is None else now
+        since = now - window
+        with self.lock:
+            # Samples are appended in time order, so the window starts at a binary-searched sample
+            low, high = self.seq - min(self.seq, self.capacity), self.seq
+            oldest = low
+            while low < high:
+                middle = (low + high) // 2
+                if self.times[middle % self.capacity] < since:
+                    low = middle + 1
+                else:
+                    high = middle
+            slices = self._slices(low)
+            times, levels = self._column(self.times, slices), self._column(self.levels, slices)
+            rtts = sorted(rtt for rtt in self._column(self.rtts, slices) if not math.isnan(rtt))
+            losses = [loss for loss in self._column(self.losses, slices) if not math.isnan(loss)]
+            # the level at the start of the window is the one of the sample before it
+            before = self.levels[(low - 1) % self.capacity] if low > oldest else None
+        up = covered = 0.0
+        flaps = 0
+        previous, start = before, since if before is not None else None
+        for moment, level in zip(times, levels):
+            if start is not None:  # each level holds until the next sample
+                covered += moment - start
+                up += moment - start if previous == 3 else 0
+            flaps += previous is not None and level != previous
+            previous, start = level, moment
+        if start is not None:
+            covered += now - start
+            up += now - start if previous == 3 else 0
+        rounded = lambda value, digits=1: None if value is None else round(value, digits)
+        return {"window": window, "samples": len(times), "flaps": flaps,
+                "rtt_p50": rounded(_percentile(rtts, 0.5)), "rtt_p95": rounded(_percentile(rtts, 0.95)),
+                "loss": rounded(sum(losses) / len(losses), 3) if losses else None,
+                "availability": rounded(100 * up / covered) if covered else None}
+
+    def __len__(self):
+        return min(self.seq, self.capacity)
+
+class HistoryStore:
+    """ProbeHistory of every interface by name, kept when the Interface objects are created again"""
+    def __init__(self, capacity=HISTORY_SAMPLES):
+        self.capacity = capacity
+        self.histories = {}
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        with self.lock:
+            history = self.histories.get(name)
+            if history is None:
+                history = self.histories[name] = ProbeHistory(self.capacity)
+            return history
+
+    def export(self, metrics):
+        """Metrics collector: windowed summaries as gauges, computed at scrape time"""
+        with self.lock:
+            histories = list(self.histories.items())
+        for name, history in histories:
+            summary = history.summary()
+            for gauge, key in (("interface_rtt_p50_milliseconds", "rtt_p50"), ("interface_rtt_p95_milliseconds", "rtt_p95"),
+                               ("interface_availability_ratio", "availability"), ("interface_flaps", "flaps")):
+                if summary[key] is not None:
+                    value = summary[key] / 100 if key == "availability" else summary[key]
+                    metrics.set(gauge, value, interface=name)
+
+histories = HistoryStore()
+metrics.collectors.append(histories.export)
+
+def quantize_weight(raw, last):
+    """Round to a whole weight, but keep the last one while raw stays within WEIGHT_HYSTERESIS of it"""
+    if last is not None and abs(raw - last) < WEIGHT_HYSTERESIS:
+        return last
+    return max(1, round(raw))
+
 class Interface():
-    def __init__(self, name):
+    def __init__(self, name, inventory=inventory, planner=planner, scheduler=scheduler, histories=histories):
         self.name = name
+        self.inventory = inventory
+        self.planner = planner
+        self.scheduler = scheduler
         self.ip = None
         self.statuses = [Element('gray','Disconnected'), #-1
             Element('red','No Internet connection'),     #0
@@ -128,97 +1137,513 @@ class Interface():
         self.last_level = -1
         self.last_last_level = -1
         self.last_check = 0
+        self.last_update = 0
+        self.results = {}
+        self.quality = QualityTracker()
+        self.history = histories.get(name)
+        self.weight = None
+        self.blend_weights = {}     # blend weight for each dispatch pool priority other than the INTERFACES one
+        self.goodput = None         # bits/s measured by the throughput probe
+        self.capacity_share = None  # goodput relative to the fastest interface
     def check_for_level(self,level):
         if level <= 0:
-            interfaces = interface_list()
-            for i in interfaces.keys():
-                #print(f"    {self.name} {i}")
-                if self.name.lower() == i.lower():
-                    self.ip = interfaces[self.name][0]
-                    return True
-        elif level == 1:
-            dns,packets,pings = ping(WHITELISTED_URL,self.ip)
-            if dns or pings[1]:
-                return True
-        elif level == 2:
-            dns,packets,pings = ping(WHITELISTED_URL,self.ip)
-            if pings[1]:
-                return True
-        elif level == 3:
-            dns,packets,pings = ping(NOT_WHITELISTED_URL,self.ip)
-            if pings[1]:
-                return True
-        return False
-    def update(self):
-        delta = time.time()-self.last_check
-        if delta < 30: 
-            device_available = self.check_for_level(0)
-            if device_available:
-                if self.last_level == -1:
-                    self.last_level = 0
-                    self.status = self.statuses[0]
-                    #go and check for an upgrade
-                else:
-                    return self.status
-            else:
-                if self.last_level > -1:
-                    self.last_level = -1
-                    self.status = self.statuses[0]
-                return self.status
-        self.last_check = time.time()
-        level = self.last_level
-        
-        available = self.check_for_level(level)
-        if available:
-            if level == -1:
-                level = 0
-            #try to upgrade level
-            while level < 3:
-                level += 1
-                available = self.check_for_level(level)
-                if not available: 
-                    level -= 1
-                    break
-        else:
-            #try to downgrade level, 'cause current one is not available
-            while level > 0:
-                level -= 1
-                available = self.check_for_level(level)
-                if available: break
+            return self.note_addresses(self.inventory.lookup(self.name))
+        results = self.planner.run(self, self.planner.plan([level]))
+        return LEVEL_CHECKS[level](results)
+    def apply_results(self, present, results, previous=None):
+        """Set the level from the results of one probe plan, with the same upgrade/downgrade ladder as always"""
+        self.results = results
+        result = results.get('full') or results.get('whitelisted')
+        rtt = loss = None
+        if result:
+            self.quality.add(result)
+            self.weight = self.compute_weight()
+            self.blend_weights = {priority: self.compute_weight("blend", priority) for priority in self.blend_weights}
+            rtt, loss = result[2][1], 1.0 if result[1][2] is None else result[1][2] / 100
+        def passed(level):
+            if level <= 0:
+                return present
+            return LEVEL_CHECKS[level](results)
+        level = decide_level(self.last_level, passed)
+        self.scheduler.reschedule(self, self.last_level if previous is None else previous, level, bool(loss))
         self.last_level = level
         self.status = self.statuses[level+1]
+        self.history.append(level, rtt, loss)
         return self.status
+    def compute_weight(self, mode=None, priority=None):
+        """dispatch weight from the configured priority (or a dispatch pool instance's own) and/or the measured quality,
+        depending on WEIGHT_MODE"""
+        mode = mode or WEIGHT_MODE
+        if priority is not None and mode == "blend":
+            return quantize_weight(self.quality.score() * priority, self.blend_weights.get(priority))
+        priority = INTERFACES.get(self.name, 1)
+        if mode == "quality":
+            raw = self.quality.score() * WEIGHT_STEPS
+        elif mode == "blend":
+            raw = self.quality.score() * priority
+        elif mode == "capacity":
+            if self.capacity_share is None:
+                return None  # not measured yet, dispatch_weight falls back to the priority
+            raw = self.capacity_share * WEIGHT_STEPS
+        else:
+            return priority
+        return quantize_weight(raw, self.weight)
+    def dispatch_weight(self, priority=None):
+        """priority overrides the INTERFACES one (a dispatch pool instance's own priorities)"""
+        if WEIGHT_MODE == "static" or self.weight is None:
+            return INTERFACES.get(self.name, 1) if priority is None else priority
+        if WEIGHT_MODE == "blend" and priority is not None and priority != INTERFACES.get(self.name, 1):
+            if priority not in self.blend_weights:
+                self.blend_weights[priority] = self.compute_weight("blend", priority)
+            return self.blend_weights[priority]
+        return self.weight
+    def invalidate(self):
+        """Run a full probe on the next update"""
+        self.last_check = 0
+        self.scheduler.invalidate(self)
+    def update(self):
+        previous = self.last_level
+        self.record_time()
+        status = self._update(previous)
+        self.record_level(previous)
+        return status
+    def record_time(self):
+        now = time.time()
+        if self.last_update:
+            metrics.inc("interface_level_seconds_total", now - self.last_update, interface=self.name, level=self.last_level)
+        self.last_update = now
+    def record_level(self, previous):
+        if self.last_level != previous:
+            metrics.inc("level_transitions_total", interface=self.name, **{"from": previous, "to": self.last_level})
+        metrics.set("interface_level", self.last_level, interface=self.name)
+    def note_addresses(self, ips):
+        """Take the address from a `dispatch list` entry, returns whether the interface is present"""
+        if ips:
+            self.ip = ips[0]
+            return True
+        return False
+    def begin_update(self, present):
+        """Cheap step of every update, returns whether a full probe is due now (and marks its start)"""
+        if not self.scheduler.due(self) and not self.note_presence(present):
+            return False
+        self.last_check = time.time()
+        return True
+    def note_presence(self, device_available):
+        """Cheap step between full probes, returns whether a full probe is needed right now"""
+        if device_available:
+            if self.last_level == -1:
+                self.last_level = 0
+                self.status = self.statuses[0]
+                self.history.append(0)
+                return True #go and check for an upgrade
+            return False
+        if self.last_level > -1:
+            self.last_level = -1
+            self.status = self.statuses[0]
+            self.history.append(-1)
+        return False
+    def _update(self, previous):
+        present = self.check_for_level(0)
+        if not self.begin_update(present):
+            return self.status
+        # Every probe the ladder may need runs once, concurrently, instead of one level after another
+        results = self.planner.probe(self, self.last_level) if present else {}
+        return self.apply_results(present, results, previous)
+def dispatch_arguments(available, priorities=None):
+    """dispatch addresses ("ip/priority") for the given interfaces"""
+    return [interface.ip+'/'+str(dispatch_key(interface, priorities)[1]) for interface in available]
+
+def dispatch_key(interface, priorities=None):
+    """What dispatch is started with for an interface, a change of it needs a restart"""
+    return (interface.ip, interface.dispatch_weight((priorities or {}).get(interface.name)))
+
+class RestartDamper:
+    """Sits between level computation and DispatchController.restart, turning bursts of changes into few restarts"""
+    def __init__(self, settle=RESTART_SETTLE, up_confirm=RESTART_UP_CONFIRM, down_confirm=RESTART_DOWN_CONFIRM, min_gap=RESTART_MIN_GAP, priorities=None):
+        self.priorities = priorities
+        self.settle = settle
+        self.up_confirm = up_confirm
+        self.down_confirm = down_confirm
+        self.min_gap = min_gap
+        self.confirmed = {}  # name -> (ip, weight) of interfaces confirmed at level 3
+        self.streaks = {}    # name -> probe results in a row that disagreed with the confirmed state
+        self.evidence = {}   # name -> history.seq of the last result counted in its streak
+        self.applied = {}    # what dispatch was last (re)started with
+        self.observed = {}
+        self.pending_since = None
+        self.last_restart = 0
+        self.changes = 0
+        self.restarts = 0
+
+    @property
+    def suppressed(self):
+        """Restarts an undamped monitor would have done on top of the ones that happened"""
+        return max(0, self.changes - self.restarts)
+
+    def reset(self, available):
+        """Dispatch was just started with these interfaces"""
+        self.confirmed = {interface.name: dispatch_key(interface, self.priorities) for interface in available}
+        self.applied = dict(self.confirmed)
+        self.observed = dict(self.confirmed)
+        self.streaks = {}
+        self.evidence = {}
+        self.pending_since = None
+        self.last_restart = time.time()
+
+    def observe(self, interfaces):
+        """Feed one monitoring cycle, returns the interfaces to restart dispatch with when a restart is due, None otherwise"""
+        now = time.time()
+        observed = {interface.name: dispatch_key(interface, self.priorities) for interface in interfaces if interface.last_level == 3}
+        if observed != self.observed:
+            self.changes += 1
+            self.observed = observed
+        for interface in interfaces:
+            name = interface.name
+            want, have = observed.get(name), self.confirmed.get(name)
+            if want == have:
+                self.streaks[name] = 0
+                continue
+            # Cycles between full probes only repeat the last result, a streak step needs a new one
+            # (a full probe or a presence change, both recorded in the history)
+            if self.evidence.get(name) == interface.history.seq:
+                continue
+            self.evidence[name] = interface.history.seq
+            self.streaks[name] = self.streaks.get(name, 0) + 1
+            # Losing an interface (or a change of its address or weight) is confirmed separately from gaining one
+            needed = self.up_confirm if have is None else self.down_confirm
+            if self.streaks[name] >= needed:
+                self.streaks[name] = 0
+                if want is None:
+                    del self.confirmed[name]
+                else:
+                    self.confirmed[name] = want
+        if self.confirmed == self.applied:
+            self.pending_since = None
+            return None
+        if self.pending_since is None:
+            self.pending_since = now
+        if now - self.pending_since < self.settle or now - self.last_restart < self.min_gap:
+            return None
+        self.applied = dict(self.confirmed)
+        self.pending_since = None
+        self.last_restart = now
+        self.restarts += 1
+        print(f"Restarting dispatch with {len(self.applied)} interfaces ({self.suppressed} restarts suppressed so far)")
+        return [interface for interface in interfaces if interface.name in self.applied]
+
+class StateStore:
+    """Persists the last known level, IP and quality of every interface, so a restart can bring dispatch up before probing"""
+    def __init__(self, path=None):
+        self.path = STATE_FILE if path is None else path
+        self.saved = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        """{name: {"level", "ip", "weight", "rtt", "loss", "time"}}, empty when there is no usable state file"""
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, ValueError) as e:
+            print(f"Ignoring state file {self.path}: {e}")
+            return {}
+
+    def save(self, interfaces):
+        """Called every cycle, writes only when a level, IP or weight changed"""
+        if not self.path:
+            return False
+        key = {interface.name: (interface.last_level, interface.ip, interface.weight) for interface in interfaces}
+        with self.lock:
+            if key == self.saved:
+                return False
+            state = {interface.name: {"level": interface.last_level, "ip": interface.ip, "weight": interface.weight,
+                                      "rtt": interface.quality.rtt, "loss": interface.quality.loss, "time": time.time()}
+                     for interface in interfaces}
+            try:
+                # Written next to it and renamed, a crash mid-write leaves the previous state intact
+                with open(self.path + ".tmp", "w", encoding="utf-8") as file:
+                    json.dump(state, file)
+                os.replace(self.path + ".tmp", self.path)
+            except OSError as e:
+                print(f"Failed to save state to {self.path}: {e}")
+                return False
+            self.saved = key
+            return True
+
+    def warm_start(self, interfaces, index):
+        """Restore the saved state of interfaces that still have the same IP in the `dispatch list` snapshot index,
+        returns the ones that were at full access. Full probes confirm them on the next cycle, as their deadline is now"""
+        saved = self.load()
+        available = []
+        for interface in interfaces:
+            entry = saved.get(interface.name)
+            present = index.get(interface.name.lower())
+            if not entry or not present or entry.get("ip") not in present[1]:
+                continue
+            interface.ip = entry["ip"]
+            interface.last_level = entry["level"]
+            interface.status = interface.statuses[interface.last_level + 1]
+            interface.weight = entry.get("weight")
+            interface.quality.rtt = entry.get("rtt")
+            interface.quality.loss = entry.get("loss")
+            interface.invalidate()
+            if interface.last_level == 3:
+                available.append(interface)
+        if available:
+            print(f"Warm start with the last known good interfaces: {', '.join(interface.name for interface in available)}")
+        return available
+
+def measure_throughput(url, interface, nbytes=None, timeout=None):
+    """Download up to nbytes of an http(s) url from the interface address.
+    Returns (bytes received, goodput in bits/s), goodput is timed from the first byte of the body"""
+    nbytes = THROUGHPUT_BYTES if nbytes is None else nbytes
+    timeout = THROUGHPUT_TIMEOUT if timeout is None else timeout
+    parts = urllib.parse.urlsplit(url)
+    secure = parts.scheme == "https"
+    host = parts.hostname
+    port = parts.port or (443 if secure else 80)
+    path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+    addresses = resolve(host, interface)
+    if not addresses:
+        raise OSError(f"can't resolve {host}")
+    sock = socket.socket(_family(addresses[0]), socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        if interface:
+            sock.bind((interface, 0))
+        sock.connect((addresses[0], port))
+        if secure:
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=host)
+        sock.sendall((f"GET {path} HTTP/1.1\r\nHost: {host}\r\nRange: bytes=0-{nbytes - 1}\r\n"
+                      "User-Agent: dispatch-proxy-manager\r\nConnection: close\r\n\r\n").encode())
+        head = b""
+        while b"\r\n\r\n" not in head:
+            data = sock.recv(65536)
+            if not data:
+                raise OSError("connection closed before the response headers")
+            head += data
+        head, body = head.split(b"\r\n\r\n", 1)
+        status = head.split(b" ", 2)[1] if b" " in head else b""
+        if status not in (b"200", b"206"):
+            raise OSError(f"unexpected HTTP status {status.decode(errors='ignore')}")
+        start = time.perf_counter()
+        received = min(len(body), nbytes)  # a server that ignores Range may have sent more with the headers
+        while received < nbytes:
+            data = sock.recv(min(65536, nbytes - received))
+            if not data:
+                break
+            received += len(data)
+        elapsed = max(time.perf_counter() - start, 1e-6)
+        return received, received * 8 / elapsed
+    finally:
+        sock.close()
+
+class ThroughputProber:
+    """Measures goodput of every full access interface on its own slow schedule, within a byte budget per hour"""
+    def __init__(self, interfaces, url=None, nbytes=THROUGHPUT_BYTES, interval=THROUGHPUT_INTERVAL, budget=THROUGHPUT_BUDGET):
+        self.interfaces = interfaces
+        self.url = url or THROUGHPUT_URL
+        self.nbytes = nbytes
+        self.interval = interval
+        self.budget = budget
+        self.spent = deque()  # (time, bytes) of the last hour
+        self.thread = None
+
+    def budget_left(self):
+        now = time.time()
+        while self.spent and now - self.spent[0][0] >= 3600:
+            self.spent.popleft()
+        return self.budget - sum(spent for _, spent in self.spent)
+
+    def run_once(self):
+        for interface in list(self.interfaces):
+            if interface.last_level != 3 or not interface.ip:
+                continue
+            if self.budget_left() < self.nbytes:
+                print("Throughput probe budget for this hour is used up")
+                break
+            try:
+                received, goodput = measure_throughput(self.url, interface.ip, self.nbytes)
+            except Exception as e:
+                print(f"Throughput probe of {interface.name} failed: {e}")
+                continue
+            self.spent.append((time.time(), received))
+            interface.goodput = goodput
+            print(f"{interface.name} goodput: {goodput / 1e6:.1f} Mbit/s")
+        measured = [interface for interface in self.interfaces if interface.goodput]
+        fastest = max([interface.goodput for interface in measured], default=0)
+        for interface in measured:
+            interface.capacity_share = interface.goodput / fastest
+            interface.weight = interface.compute_weight()
+
+    def run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception:
+                print(traceback.format_exc())
+            time.sleep(self.interval)
+
+    def start(self):
+        if self.url and self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+class ProbeExecutor:
+    def __init__(self, max_workers=PROBE_WORKERS, deadline=PROBE_DEADLINE):
+        self.pool = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="probe")
+        self.deadline = deadline
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def _update(self, interface):
+        try:
+            return interface.update()
+        except Exception:
+            print(f"Error while updating {interface.name}")
+            print(traceback.format_exc())
+            return interface.status
+
+    def update_all(self, interfaces):
+        """Update all interfaces concurrently, returns the ones that missed the cycle deadline"""
+        with self.lock:
+            futures = {}
+            for interface in interfaces:
+                future = self.pending.get(interface)
+                # An update that overran the previous deadline is still running, wait for it instead of starting another one
+                if future is None or future.done():
+                    future = self.pool.submit(self._update, interface)
+                    self.pending[interface] = future
+                futures[future] = interface
+        done, not_done = wait(futures, timeout=self.deadline)
+        late = [futures[future] for future in not_done]
+        for interface in late:
+            print(f"{interface.name} did not finish probing within {self.deadline}s, keeping its last status")
+        return late
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+class RingBuffer:
+    """Keeps the last `capacity` lines, numbered so readers can ask only for lines they haven't seen"""
+    def __init__(self, capacity=OUTPUT_BUFFER_LINES):
+        self.lines = deque(maxlen=max(1, capacity))
+        self.seq = 0  # lines appended so far, the cursor after the newest line
+        self.lock = threading.Lock()
+
+    def append(self, line):
+        with self.lock:
+            self.lines.append(line)
+            self.seq += 1
+
+    def read_since(self, cursor=0):
+        """Returns (lines appended after cursor, new cursor, lines dropped before the reader got to them)"""
+        with self.lock:
+            first = self.seq - len(self.lines)
+            if cursor > self.seq:  # cursor of an older buffer, start over
+                cursor = 0
+            start = max(cursor, first)
+            # Walk from the newest end so a read costs O(new lines), not O(capacity)
+            lines = list(itertools.islice(reversed(self.lines), self.seq - start))
+            lines.reverse()
+            return lines, self.seq, start - cursor
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.lines))
+
+    def __len__(self):
+        return len(self.lines)
+
+class ReadyWait:
+    """One wait for a started server: ready once it printed its banner or its port accepted a connection, failed as soon
+    as it exits or when the timeout passes. Shared by ServerController.wait_ready and the daemon's AsyncDispatch"""
+    def __init__(self, ready, timeout=None):
+        self.ready = ready
+        self.deadline = time.time() + (DISPATCH_READY_TIMEOUT if timeout is None else timeout)
+
+    def check(self, exited, accepted=False):
+        """True when it is ready, False when it exited, None while still waiting"""
+        if accepted:
+            self.ready.set()
+        if self.ready.is_set():
+            return True
+        if exited:
+            return False
+        return None
+
+    def pause(self):
+        """How long to wait for the banner before checking again, None once the timeout passed"""
+        left = self.deadline - time.time()
+        return min(0.05, left) if left > 0 else None
+
 class ServerController:
-    def __init__(self, server_path, args=None):
+    def __init__(self, server_path, args=None, ready_port=None, ready_host=DISPATCH_HOST):
         self.server_path = server_path
         self.process = None
         self.args = args
-        self.stdout_buffer = []
-        self.stderr_buffer = []
+        self.ready_port = ready_port
+        self.ready_host = ready_host
+        self.ready_pattern = re.compile(DISPATCH_READY_PATTERN) if DISPATCH_READY_PATTERN else None
+        self.ready = threading.Event()
+        self.stdout_buffer = RingBuffer()
+        self.stderr_buffer = RingBuffer()
         self.stdout_thread = None
         self.stderr_thread = None
+        self.stopping = False  # set while the process is stopped on purpose, an exit otherwise is a crash
+        self.on_start = []     # called with every new process
+        self.lock = threading.RLock()
     
-    def _read_stdout(self):
+    # Readers get their stream and buffer passed in, so they keep working when a process is handed to another controller
+    def _read_stdout(self, stream, buffer, ready=None):
         """Thread function to read stdout non-blockingly"""
-        while self.process and self.process.stdout:
-            line = self.process.stdout.readline()
+        while stream:
+            line = stream.readline()
             if line:
                 decoded = line.decode('utf-8', errors='ignore').rstrip()
-                self.stdout_buffer.append(decoded)
+                buffer.append(decoded)
+                self._check_banner(decoded, ready)
                 print(f"[STDOUT] {decoded}")
             else:
                 break
     
-    def _read_stderr(self):
+    def _read_stderr(self, stream, buffer, ready=None):
         """Thread function to read stderr non-blockingly"""
-        while self.process and self.process.stderr:
-            line = self.process.stderr.readline()
+        while stream:
+            line = stream.readline()
             if line:
                 decoded = line.decode('utf-8', errors='ignore').rstrip()
-                self.stderr_buffer.append(decoded)
+                buffer.append(decoded)
+                self._check_banner(decoded, ready)
                 print(f"[STDERR] {decoded}")
             else:
                 break
+
+    def _check_banner(self, line, ready):
+        if ready is not None and not ready.is_set() and self.ready_pattern and self.ready_pattern.search(line):
+            ready.set()
+
+    def wait_ready(self, timeout=None):
+        """Wait until the server printed its banner or accepts connections on ready_port.
+        Returns True when it is ready, False as soon as it exits or when the timeout passes"""
+        process, wait = self.process, ReadyWait(self.ready, timeout)
+        while True:
+            result = wait.check(process.poll() is not None)
+            if result is None and self.ready_port:
+                result = wait.check(False, self._accepts())
+            if result is not None:
+                return result
+            pause = wait.pause()
+            if pause is None:
+                return False
+            wait.ready.wait(pause)
+
+    def _accepts(self):
+        try:
+            socket.create_connection((self.ready_host, self.ready_port), timeout=0.2).close()
+            return True
+        except OSError:
+            return False
                 
     def start(self):
         """Start the server"""
@@ -243,48 +1668,49 @@ class ServerController:
                 creationflags=creationflags
             )
             print(f"Server started with PID: {self.process.pid}")
+            self.stopping = False
+            for hook in self.on_start:
+                hook(self.process)
 
-            # Start threads to read output non-blockingly
-            self.stdout_thread = threading.Thread(target=self._read_stdout, daemon=True)
-            self.stderr_thread = threading.Thread(target=self._read_stderr, daemon=True)
+            # Start threads to read output non-blockingly, they also watch for the ready banner of this process
+            self.ready = threading.Event()
+            self.stdout_thread = threading.Thread(target=self._read_stdout, args=(self.process.stdout, self.stdout_buffer, self.ready), daemon=True)
+            self.stderr_thread = threading.Thread(target=self._read_stderr, args=(self.process.stderr, self.stderr_buffer, self.ready), daemon=True)
             self.stdout_thread.start()
             self.stderr_thread.start()
             
-            # Give the process a moment to start
-            time.sleep(2)
+            # Return as soon as it is up instead of a fixed delay
+            start = time.perf_counter()
+            if self.wait_ready():
+                print(f"Server ready after {time.perf_counter() - start:.2f}s")
+                return True
             
             # Check if process is still alive
-            if self.process.poll() is not None:
-                print(f"Server terminated immediately with exit code: {self.process.returncode}")
-                # Try to get any error output
-                try:
-                    stdout, stderr = self.process.communicate(timeout=1)
-                    if stdout:
-                        print(f"Last stdout: {stdout.decode('utf-8', errors='ignore')}")
-                    if stderr:
-                        print(f"Last stderr: {stderr.decode('utf-8', errors='ignore')}")
-                except:
-                    pass
+            if self.process.poll() is None:
+                print(f"Server was not ready within {DISPATCH_READY_TIMEOUT}s, stopping it")
+                self.stop(expected=False)
                 return False
-                
-            return True
+            print(f"Server terminated immediately with exit code: {self.process.returncode}")
+            # The reader threads hold the pipes, what the process wrote is in the buffers
+            if self.stdout_thread:
+                self.stdout_thread.join(timeout=1)
+            if self.stderr_thread:
+                self.stderr_thread.join(timeout=1)
+            if len(self.stderr_buffer):
+                print("Last stderr: " + "\n".join(list(self.stderr_buffer)[-10:]))
+            return False
         except Exception as e:
             print(f"Failed to start server: {e}")
             return False
         
-    def stop(self):
-        """Stop the server"""
+    def stop(self, expected=True):
+        """Stop the server, expected=False lets a supervisor handle it like a crash"""
         if self.process is None:
             print("No server process found")
             return False
         
+        self.stopping = expected
         try:
-            # First, try to read any remaining output
-            if self.stdout_thread:
-                self.stdout_thread.join(timeout=1)
-            if self.stderr_thread:
-                self.stderr_thread.join(timeout=1)
-            
             if os.name == 'nt':  # Windows
                 # Use CTRL_BREAK_EVENT for process groups
                 self.process.send_signal(signal.CTRL_BREAK_EVENT)
@@ -293,6 +1719,11 @@ class ServerController:
             
             # Wait for process to terminate
             self.process.wait(timeout=10)
+            # Then read any remaining output, the readers end right away now that the pipes are closed
+            if self.stdout_thread:
+                self.stdout_thread.join(timeout=1)
+            if self.stderr_thread:
+                self.stderr_thread.join(timeout=1)
             print("Server stopped")
             return True
         except subprocess.TimeoutExpired:
@@ -318,57 +1749,698 @@ class ServerController:
         if not output:
             output = "\n".join(self.stderr_buffer)
         return output if output else "No output available"
+
+    def read_since(self, cursor=None):
+        """Output lines (stdout, then stderr) produced after cursor - returns (lines, new cursor, dropped lines count).
+        Pass None the first time, then the cursor returned by the previous call"""
+        out_cursor, err_cursor = cursor or (0, 0)
+        out, out_cursor, out_dropped = self.stdout_buffer.read_since(out_cursor)
+        err, err_cursor, err_dropped = self.stderr_buffer.read_since(err_cursor)
+        return out + err, (out_cursor, err_cursor), out_dropped + err_dropped
+    def swap(self, other):
+        """Exchange the running process (and its output) with another controller"""
+        for name in ('process', 'args', 'stdout_thread', 'stderr_thread', 'ready', 'ready_port'):
+            mine = getattr(self, name)
+            setattr(self, name, getattr(other, name))
+            setattr(other, name, mine)
+
+def wait_for_port(port, timeout, host='127.0.0.1'):
+    """Wait until something accepts TCP connections on the port"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=0.5).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+class FrontListener:
+    """Relays client connections on the public port to the dispatch instance currently in service"""
+    def __init__(self, port, backend_port, host=DISPATCH_HOST):
+        self.backend_port = backend_port
+        self.active = {}
+        self.lock = threading.Lock()
+        self.server = socket.create_server((host, port))
+        self.running = True
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+
+    def switch(self, backend_port):
+        """New connections go to backend_port, the ones already open stay where they are"""
+        self.backend_port = backend_port
+
+    def connections(self, backend_port):
+        return self.active.get(backend_port, 0)
+
+    def _accept_loop(self):
+        while self.running:
+            try:
+                client, _ = self.server.accept()
+            except OSError:
+                break
+            backend_port = self.backend_port
+            with self.lock:
+                self.active[backend_port] = self.active.get(backend_port, 0) + 1
+            threading.Thread(target=self._relay, args=(client, backend_port), daemon=True).start()
+
+    def _pump(self, source, destination):
+        try:
+            while True:
+                data = source.recv(65536)
+                if not data:
+                    break
+                destination.sendall(data)
+        except OSError:
+            pass
+        finally:
+            try:
+                destination.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+    def _relay(self, client, backend_port):
+        try:
+            upstream = socket.create_connection(('127.0.0.1', backend_port))
+        except OSError:
+            upstream = None
+        try:
+            if upstream:
+                other = threading.Thread(target=self._pump, args=(upstream, client), daemon=True)
+                other.start()
+                self._pump(client, upstream)
+                other.join()
+        finally:
+            for sock in (client, upstream):
+                if sock:
+                    sock.close()
+            with self.lock:
+                self.active[backend_port] -= 1
+
+    def close(self):
+        self.running = False
+        self.server.close()
+
 class DispatchController(ServerController):
-    def __init__(self, interfaces):
+    def __init__(self, interfaces, mode=RESTART_MODE, port=None, standby_ports=None):
         print("Starting with:",interfaces)
-        interfaces.insert(0,"start")
-        super().__init__(DISPATCH_EXE,interfaces)
+        self.mode = mode
+        self.front = None
+        self.listen_port = port or DISPATCH_PORT
+        self.standby_ports = standby_ports or DISPATCH_STANDBY_PORTS
+        # dispatch is always told its port, the one readiness and health checks connect to
+        self.port = self.listen_port
+        self.draining = {}
+        if mode == "bluegreen":
+            # dispatch instances take turns on the standby ports behind the front listener
+            self.port = self.standby_ports[0]
+        # In bluegreen mode listen_port is the front listener, readiness has to be checked on the instance's own port
+        super().__init__(DISPATCH_EXE,self._arguments(interfaces, self.port), ready_port=self.port)
         self.start()
+    def _arguments(self, interfaces, port):
+        return ["start", "--port", str(port)] + list(interfaces)
+    # The monitor and the supervisor both start and stop dispatch, the lock keeps them from doing it at the same time
+    def start(self):
+        with self.lock:
+            if self.mode == "bluegreen" and self.front is None:
+                self.front = FrontListener(self.listen_port, self.port)
+            return super().start()
+    def stop(self, expected=True):
+        with self.lock:
+            result = super().stop(expected)
+            for port in list(self.draining):
+                old = self.draining.pop(port, None)
+                if old:
+                    old.stop()
+            if self.front:
+                self.front.close()
+                self.front = None
+            return result
     def restart(self,interfaces):
         print("Restarting with:",interfaces)
-        self.stop()
-        if len(interfaces) == 0: return
-        interfaces.insert(0,"start")
-        self.args = interfaces
-        return self.start()
+        metrics.inc("dispatch_restarts_total")
+        with self.lock:
+            if self.mode == "bluegreen" and self.is_running() and len(interfaces):
+                return self._blue_green_restart(interfaces)
+            down = time.time()
+            ServerController.stop(self)
+            if len(interfaces) == 0: return
+            self.args = self._arguments(interfaces, self.port)
+            try:
+                return self.start()
+            finally:
+                metrics.inc("dispatch_restart_downtime_seconds_total", time.time() - down)
+    def _blue_green_restart(self, interfaces):
+        """Bring the new instance up on the standby port, switch new connections to it, then drain the old one"""
+        port = next(p for p in self.standby_ports if p != self.port)
+        leftover = self.draining.pop(port, None)
+        if leftover:
+            leftover.stop()
+        standby = ServerController(DISPATCH_EXE, self._arguments(interfaces, port), ready_port=port)
+        # Both instances write into the same buffers, so readers' cursors stay valid across the switch
+        standby.stdout_buffer = self.stdout_buffer
+        standby.stderr_buffer = self.stderr_buffer
+        standby.on_start = self.on_start  # the new process is the one to supervise from now on
+        if not standby.start():
+            print(f"Standby dispatch on port {port} did not come up, keeping the current one")
+            standby.stop()
+            return False
+        old_port = self.port
+        self.swap(standby)  # standby now holds the old process
+        self.port = port
+        self.front.switch(port)
+        self.draining[old_port] = standby
+        threading.Thread(target=self._drain, args=(standby, old_port), daemon=True).start()
+        return True
+    def _drain(self, old, port):
+        deadline = time.time() + DRAIN_TIMEOUT
+        while self.front and self.front.connections(port) and time.time() < deadline:
+            time.sleep(0.5)
+        if self.draining.get(port) is old:
+            print(f"Old dispatch on port {port} drained")
+            old.stop()
+            # Only free the port once the old process is gone
+            if self.draining.get(port) is old:
+                del self.draining[port]
+
+class CrashTracker:
+    """Exit codes and last stderr lines of dispatch crashes, and how long to wait before restarting after each one"""
+    def __init__(self, backoff_min=SUPERVISOR_BACKOFF_MIN, backoff_max=SUPERVISOR_BACKOFF_MAX, limit=SUPERVISOR_CRASH_LIMIT,
+                 window=SUPERVISOR_CRASH_WINDOW, stderr_lines=SUPERVISOR_STDERR_LINES):
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.limit = limit
+        self.window = window
+        self.stderr_lines = stderr_lines
+        self.crashes = deque(maxlen=100)  # {"time", "code", "uptime", "stderr"}
+        self.backoff = backoff_min
+        self.gave_up = False
+        self.lock = threading.Lock()
+
+    def record(self, code, stderr_buffer, uptime):
+        """Note a crash, returns the delay before restarting or None when dispatch crash-loops and should stay down"""
+        now = time.time()
+        metrics.inc("dispatch_crashes_total")
+        with self.lock:
+            self.crashes.append({"time": now, "code": code, "uptime": round(uptime, 1),
+                                 "stderr": list(stderr_buffer)[-self.stderr_lines:] if self.stderr_lines else []})
+            print(f"dispatch exited by itself with code {code} after {uptime:.1f}s")
+            for line in self.crashes[-1]["stderr"]:
+                print(f"  {line}")
+            if uptime >= self.backoff_max:
+                self.backoff = self.backoff_min  # it ran fine for a while, this is not the same crash loop
+            if len([crash for crash in self.crashes if now - crash["time"] < self.window]) >= self.limit:
+                self.gave_up = True
+                print(f"dispatch crashed {self.limit} times within {self.window:.0f}s, leaving it down until it is started again")
+                return None
+            delay, self.backoff = self.backoff, min(self.backoff * 2, self.backoff_max)
+            return delay
+
+    def reset(self):
+        """dispatch was started on purpose, forget the crash loop"""
+        with self.lock:
+            self.crashes.clear()
+            self.backoff = self.backoff_min
+            self.gave_up = False
+
+    def last(self):
+        return self.crashes[-1] if self.crashes else None
+
+    @staticmethod
+    def supervised(owner, process):
+        """Whether process is still the one owner (a ServerController or the daemon's AsyncDispatch) runs, and wasn't
+        stopped on purpose: an exit is a crash, and a restart after the backoff is still wanted"""
+        return process is owner.process and not owner.stopping
+
+class DispatchSupervisor:
+    """Waits on every dispatch process (one thread each) and restarts it with the current interfaces when it exits by itself"""
+    def __init__(self, controller, tracker=None, on_crash=None):
+        self.controller = controller
+        self.tracker = tracker or CrashTracker()
+        self.on_crash = on_crash  # called with the crash record and the restart delay (None when giving up)
+        controller.on_start.append(self.watch)
+        if controller.process is not None:
+            self.watch(controller.process)  # started before the supervisor was attached
+
+    def watch(self, process):
+        threading.Thread(target=self._wait, args=(process, time.time()), daemon=True).start()
+
+    def _wait(self, process, started):
+        code = process.wait()
+        if not self.tracker.supervised(self.controller, process):
+            return  # replaced by a restart, or stopped on purpose
+        if self.controller.stderr_thread:
+            self.controller.stderr_thread.join(timeout=1)  # its last words
+        delay = self.tracker.record(code, self.controller.stderr_buffer, time.time() - started)
+        if self.on_crash:
+            self.on_crash(self.tracker.last(), delay)
+        if delay is None:
+            return
+        time.sleep(delay)
+        with self.controller.lock:
+            if self.tracker.supervised(self.controller, process):
+                print(f"Restarting dispatch after a crash (waited {delay:g}s)")
+                self.controller.start()
+
+class DispatchInstance:
+    """One listener of the dispatch pool: its port, its interface group and priorities, and its own restart damping"""
+    def __init__(self, name, port=None, interfaces=None, mode=RESTART_MODE, standby_ports=None, settle=RESTART_SETTLE,
+                 up_confirm=RESTART_UP_CONFIRM, down_confirm=RESTART_DOWN_CONFIRM, min_gap=RESTART_MIN_GAP):
+        self.config = {"name": name, "port": port, "interfaces": interfaces, "mode": mode, "standby_ports": standby_ports,
+                       "settle": settle, "up_confirm": up_confirm, "down_confirm": down_confirm, "min_gap": min_gap}
+        self.name = name
+        self.port = port
+        self.mode = mode
+        self.standby_ports = standby_ports
+        # A list of names keeps the INTERFACES priorities, a dict sets this instance's own
+        interfaces = INTERFACES if interfaces is None else interfaces
+        if isinstance(interfaces, dict):
+            self.priorities = dict(interfaces)
+        else:
+            self.priorities = {name: INTERFACES.get(name, 1) for name in interfaces}
+        self.damper = RestartDamper(settle, up_confirm, down_confirm, min_gap, priorities=self.priorities)
+        self.available = []
+        self.active = False  # started, and not stopped since
+        self.controller = None
+        self.supervisor = None
+        self.on_crash = None  # called with (instance, crash, restart delay) by its supervisor
+        self.health = HealthTracker(name)
+
+    def members(self, interfaces):
+        return [interface for interface in interfaces if interface.name in self.priorities]
+
+    def arguments(self):
+        return dispatch_arguments(self.available, self.priorities)
+
+    def prepare(self, available):
+        """Mark it started with the members of available, forgetting the last run's damping and health checks.
+        Returns the dispatch arguments, empty when none of its interfaces is up. Shared with the daemon"""
+        self.active = True
+        self.available = self.members(available)
+        self.damper.reset(self.available)
+        self.health.reset()
+        arguments = self.arguments()
+        if not arguments:
+            print(f"[{self.name}] No available interfaces at level 3")
+        return arguments
+
+    def record_health(self, result):
+        """Feed one health check, (connect, ttfb) from proxy_probe or the OSError it raised.
+        Returns whether dispatch should be restarted now. Shared with the daemon"""
+        if isinstance(result, OSError):
+            # The uplinks may be what stopped forwarding, give them a full probe on the next cycle
+            for interface in self.available:
+                interface.invalidate()
+            return self.health.record(error=result)
+        return self.health.record(*result)
+
+    def start(self, available):
+        """Start with the members of available, returns whether dispatch is running"""
+        arguments = self.prepare(available)
+        if not arguments:
+            return False
+        self.controller = DispatchController(arguments, self.mode, self.port, self.standby_ports)
+        on_crash = (lambda crash, delay: self.on_crash(self, crash, delay)) if self.on_crash else None
+        self.supervisor = DispatchSupervisor(self.controller, on_crash=on_crash)
+        return self.controller.is_running()
+
+    def observe(self, interfaces):
+        """Feed one probing pass, returns whether this instance's set changed (only its own group counts)"""
+        new_available = self.damper.observe(self.members(interfaces))
+        if new_available is None:
+            return False
+        self.available = new_available
+        return True
+
+    def apply(self):
+        """Restart with the current set, or start if it had nothing to run with so far"""
+        if not self.active:
+            return
+        if self.controller:
+            self.controller.restart(self.arguments())
+        else:
+            self.start(self.available)
+
+    def stop(self):
+        self.active = False
+        if self.controller:
+            self.controller.stop()
+
+    def is_running(self):
+        return self.controller is not None and self.controller.is_running()
+
+class DispatchPool:
+    """Runs the DISPATCH_POOL instances from one probing pass, each restarted only when its own group changes"""
+    def __init__(self, config=None, on_crash=None):
+        config = DISPATCH_POOL if config is None else config
+        self.on_crash = on_crash
+        # Without a pool configuration a single instance behaves like one DispatchController on DISPATCH_PORT
+        self.instances = [DispatchInstance(**entry) for entry in config] or [DispatchInstance("default")]
+        self.assign_ports(self.instances)
+        for instance in self.instances:
+            instance.on_crash = on_crash
+
+    @staticmethod
+    def assign_ports(instances):
+        """Give bluegreen instances without standby_ports their own, and reject a port used twice (ValueError)"""
+        used = {}
+        for instance in instances:
+            if instance.mode == "bluegreen" and not instance.standby_ports:
+                # DISPATCH_STANDBY_PORTS are for a single listener, in a pool each one takes the two ports after its own
+                front = instance.port or DISPATCH_PORT
+                instance.standby_ports = list(DISPATCH_STANDBY_PORTS) if len(instances) == 1 else [front + 1, front + 2]
+            ports = [instance.port or DISPATCH_PORT] + (list(instance.standby_ports) if instance.mode == "bluegreen" else [])
+            for port in ports:
+                if port in used:
+                    raise ValueError(f"DISPATCH_POOL: port {port} of {instance.name} is already used by {used[port]}")
+                used[port] = instance.name
+
+    @property
+    def available(self):
+        """Interfaces used by at least one running instance"""
+        available = []
+        for instance in self.instances:
+            if instance.is_running():
+                available += [interface for interface in instance.available if interface not in available]
+        return available
+
+    def start(self, available):
+        """Returns whether at least one instance is running"""
+        return any([instance.start(available) for instance in self.instances])
+
+    def observe(self, interfaces):
+        """Feed one probing pass, returns the instances whose set changed"""
+        return [instance for instance in self.instances if instance.observe(interfaces)]
+
+    def update(self, interfaces):
+        """observe, then restart just the instances that changed"""
+        changed = self.observe(interfaces)
+        for instance in changed:
+            instance.apply()
+        return changed
+
+    def replace(self, name, **changes):
+        """New configuration (port, interfaces, mode, damping...) for one instance, returns (old, new) instance.
+        Only swaps the configuration, stopping the old one and starting the new one is up to the caller"""
+        if "name" in changes:
+            raise ValueError("an instance can't be renamed")
+        index = next((i for i, instance in enumerate(self.instances) if instance.name == name), None)
+        if index is None:
+            raise ValueError(f"Unknown instance: {name}")
+        old = self.instances[index]
+        new = DispatchInstance(**dict(old.config, **changes))
+        new.on_crash = self.on_crash
+        self.assign_ports(self.instances[:index] + [new] + self.instances[index + 1:])
+        self.instances[index] = new
+        return old, new
+
+    def stop(self):
+        for instance in self.instances:
+            instance.stop()
+
+    def is_running(self):
+        return any(instance.is_running() for instance in self.instances)
+
+    def read_since(self, cursor=None):
+        """Output of every instance since cursor, like ServerController.read_since, prefixed with the name when there are several"""
+        cursor = cursor or {}
+        lines, dropped, new_cursor = [], 0, {}
+        for instance in self.instances:
+            if instance.controller is None:
+                continue
+            out, new_cursor[instance.name], lost = instance.controller.read_since(cursor.get(instance.name))
+            lines += out if len(self.instances) == 1 else [f"[{instance.name}] {line}" for line in out]
+            dropped += lost
+        return lines, new_cursor, dropped
+
+def _recv_exactly(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise OSError("proxy closed the connection")
+        data += chunk
+    return data
+
+def socks5_connect_request(host, port):
+    """SOCKS5 CONNECT request for an IP address or a host name (resolved by the proxy)"""
+    for family, kind in ((socket.AF_INET, 1), (socket.AF_INET6, 4)):
+        try:
+            return bytes((5, 1, 0, kind)) + socket.inet_pton(family, host) + struct.pack("!H", port)
+        except OSError:
+            pass
+    name = host.encode("idna")
+    return bytes((5, 1, 0, 3, len(name))) + name + struct.pack("!H", port)
+
+def proxy_probe(url, port=None, host=None, timeout=None):
+    """Request an http(s) url through the dispatch SOCKS5 listener on host:port, the way clients use it.
+    Returns (seconds until the proxy was connected to the target, seconds from sending the request to the first response byte)"""
+    timeout = HEALTH_TIMEOUT if timeout is None else timeout
+    parts = urllib.parse.urlsplit(url)
+    secure = parts.scheme == "https"
+    target_port = parts.port or (443 if secure else 80)
+    path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+    start = time.perf_counter()
+    sock = socket.create_connection((host or DISPATCH_HOST, port or DISPATCH_PORT), timeout)
+    try:
+        sock.sendall(b"\x05\x01\x00")  # SOCKS5, one method: no authentication
+        if _recv_exactly(sock, 2) != b"\x05\x00":
+            raise OSError("proxy refused the SOCKS5 handshake")
+        sock.sendall(socks5_connect_request(parts.hostname, target_port))
+        reply = _recv_exactly(sock, 4)
+        if reply[1] != 0:
+            raise OSError(f"proxy could not connect to {parts.hostname}:{target_port} (SOCKS5 reply {reply[1]})")
+        address_length = {1: 4, 4: 16}.get(reply[3]) or _recv_exactly(sock, 1)[0]
+        _recv_exactly(sock, address_length + 2)  # bound address and port
+        connect = time.perf_counter() - start
+        start = time.perf_counter()
+        if secure:
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=parts.hostname)
+        sock.sendall((f"GET {path} HTTP/1.1\r\nHost: {parts.hostname}\r\n"
+                      "User-Agent: dispatch-proxy-manager\r\nConnection: close\r\n\r\n").encode())
+        if not sock.recv(1):
+            raise OSError("connection closed before the response")
+        return connect, time.perf_counter() - start
+    finally:
+        sock.close()
+
+class HealthTracker:
+    """Results of the health checks through one dispatch listener, decides when it needs a restart.
+    After a restart another one needs a passing check first, so a target that is down doesn't restart dispatch over and over"""
+    def __init__(self, name="default", max_latency=HEALTH_MAX_LATENCY, max_failures=HEALTH_MAX_FAILURES):
+        self.name = name
+        self.max_latency = max_latency
+        self.max_failures = max(1, max_failures)
+        self.failures = 0  # in a row
+        self.restarts = 0
+        self.holding = False  # restarted, and no check passed since
+        self.last = None
+
+    def record(self, connect=None, ttfb=None, error=None):
+        """Feed one check, returns whether dispatch should be restarted now"""
+        if error is None:
+            metrics.observe("health_connect_seconds", connect, instance=self.name)
+            metrics.observe("health_ttfb_seconds", ttfb, instance=self.name)
+            result = "slow" if self.max_latency and connect + ttfb > self.max_latency else "ok"
+        else:
+            result = "failed"
+        metrics.inc("health_checks_total", instance=self.name, result=result)
+        self.last = {"time": time.time(), "result": result, "connect": connect, "ttfb": ttfb,
+                     "error": None if error is None else str(error)}
+        if result == "ok":
+            self.failures = 0
+            self.holding = False
+            return False
+        self.failures += 1
+        detail = error if error is not None else f"{connect + ttfb:.2f}s"
+        print(f"[{self.name}] Health check through dispatch {result}: {detail} ({self.failures}/{self.max_failures})")
+        if self.failures < self.max_failures:
+            return False
+        self.failures = 0
+        if self.holding:
+            print(f"[{self.name}] Still failing after a restart, not restarting dispatch again until a check passes")
+            return False
+        self.holding = True
+        self.restarts += 1
+        metrics.inc("health_restarts_total", instance=self.name)
+        return True
+
+    def reset(self):
+        self.failures = 0
+
+class HealthChecker:
+    """Requests HEALTH_TARGET through every running pool instance on its own schedule, restarts the ones that stopped forwarding"""
+    def __init__(self, pool, url=None, interval=HEALTH_INTERVAL):
+        self.pool = pool
+        self.url = url or HEALTH_TARGET
+        self.interval = interval
+        self.thread = None
+
+    def run_once(self):
+        for instance in self.pool.instances:
+            if not instance.active or not instance.is_running() or not instance.available:
+                continue  # nothing to forward through is not dispatch's fault
+            controller = instance.controller
+            # Not while it is (re)starting, and a check that overlapped a restart tells nothing
+            if not controller.lock.acquire(blocking=False):
+                continue
+            process, ready = controller.process, controller.ready.is_set()
+            controller.lock.release()
+            if not ready:
+                continue
+            try:
+                # The port clients use: the one dispatch was started with, or the bluegreen front listener
+                result = proxy_probe(self.url, controller.listen_port)
+            except OSError as e:
+                result = e
+            if controller.process is not process or controller is not instance.controller:
+                continue
+            if instance.record_health(result) and instance.active:
+                print(f"[{instance.name}] dispatch is not forwarding, restarting it")
+                controller.restart(instance.arguments())
+
+    def run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception:
+                print(traceback.format_exc())
+            time.sleep(self.interval)
+
+    def start(self):
+        if self.url and self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+def interface_state(interface):
+    """What front-ends are told about an interface, JSON serializable"""
+    return {"name": interface.name, "ip": interface.ip, "level": interface.last_level, "status": interface.status.text,
+            "weight": interface.dispatch_weight(), "rtt": interface.quality.rtt, "loss": interface.quality.loss,
+            "history": interface.history.summary()}
+
+def control_connect(timeout=2):
+    """Connect to the control API of a running daemon (CONTROL_SOCKET first), raises OSError when none is reachable"""
+    if CONTROL_SOCKET and hasattr(socket, "AF_UNIX"):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(CONTROL_SOCKET)
+            return sock
+        except OSError:
+            sock.close()
+            if not CONTROL_PORT:
+                raise
+    if not CONTROL_PORT:
+        raise ConnectionRefusedError("The control API is disabled (CONTROL_PORT and CONTROL_SOCKET are not set)")
+    return socket.create_connection((CONTROL_HOST, CONTROL_PORT), timeout)
+
+class ControlClient:
+    """Front-end side of the control API: one-off commands, and the state and output a daemon pushes"""
+    def __init__(self, timeout=2):
+        self.timeout = timeout
+
+    def request(self, command, **args):
+        """Send one command (state, start, stop, reprobe...) and return the reply, raises RuntimeError if it failed"""
+        with control_connect(self.timeout) as sock:
+            sock.sendall((json.dumps(dict(args, cmd=command)) + "\n").encode())
+            line = sock.makefile('rb').readline()
+        if not line:
+            raise ConnectionError("The daemon closed the connection")
+        reply = json.loads(line)
+        if not reply.get("ok"):
+            raise RuntimeError(reply.get("error"))
+        return reply
+
+    def available(self):
+        """Whether a daemon answers on the control API"""
+        try:
+            self.request("ping")
+            return True
+        except (OSError, ValueError, RuntimeError):
+            return False
+
+    def subscribe(self):
+        """Yield every message the daemon pushes, the current state first, until the connection drops"""
+        with control_connect(self.timeout) as sock:
+            sock.sendall(b'{"cmd": "subscribe"}\n')
+            sock.settimeout(None)
+            for line in sock.makefile('rb'):
+                yield json.loads(line)
+
+def follow_daemon(client):
+    """Console front-end of a running daemon: prints the levels and dispatch output it pushes"""
+    for message in client.subscribe():
+        if message.get("event") == "state":
+            for interface in message["interfaces"]:
+                print(f"{interface['name']} - {interface['level']}")
+        elif message.get("event") == "output":
+            for line in message["lines"]:
+                print(line)
 
 if __name__ == '__main__':
+    client = ControlClient()
+    if client.available():
+        # One prober per machine: a second one would double the probes and fight over the dispatch process
+        print("Daemon is running, following it instead of probing (Ctrl+C to quit)")
+        try:
+            follow_daemon(client)
+        except KeyboardInterrupt:
+            pass
+        except (OSError, ValueError) as e:
+            print(f"Lost the daemon: {e}")
+        raise SystemExit(0)
     interfaces_objects =  [Interface(i) for i in INTERFACES]
-    available = []
-    for interface in interfaces_objects:
-        interface.update()
-    for interface in interfaces_objects:
-        if interface.last_level == 3:
-            available.append(interface)
-    arguments = []
-    for interface in available:
-        arguments.append(interface.ip+'/'+str(INTERFACES[interface.name]))
-    Controller = DispatchController(arguments)
+    executor = ProbeExecutor()
+    watcher = create_watcher()
+    wake = threading.Event()
+    def on_interfaces_changed(names):
+        # Re-probe just the interfaces that changed, right away
+        changed = [interface for interface in interfaces_objects if interface.name.lower() in names]
+        for interface in changed:
+            interface.invalidate()
+        executor.update_all(changed)
+        wake.set()
+    watcher.subscribe(on_interfaces_changed)
+    state_store = StateStore()
+    start_metrics_server()
+    # Start dispatch with what worked last time, the first cycle confirms it; probe first only without a usable state.
+    # Restored before the watcher starts, so its first probes aren't overwritten by the saved state
+    available = state_store.warm_start(interfaces_objects, inventory.refresh())
+    watcher.start()
+    ThroughputProber(interfaces_objects).start()
+    if not available:
+        executor.update_all(interfaces_objects)
+        for interface in interfaces_objects:
+            if interface.last_level == 3:
+                available.append(interface)
+    # Every instance gets a supervisor: exits are noticed by waiting on the process, and restarted with backoff
+    pool = DispatchPool()
+    pool.start(available)
+    HealthChecker(pool).start()
+    output_cursor = None
 
     try:
         while True:
-            for interface in interfaces_objects:
-                interface.update()
+            cycle_start = time.perf_counter()
+            # Without netlink events this takes one `dispatch list` per cycle, shared by every interface
+            watcher.poll()
+            executor.update_all(interfaces_objects)
+            metrics.observe("monitoring_cycle_seconds", time.perf_counter() - cycle_start)
+            state_store.save(interfaces_objects)
             
-            new_available = []
             for interface in interfaces_objects:
                 print(f"{interface.name} - {interface.last_level}")
-                if interface.last_level == 3:
-                    new_available.append(interface)
-            if new_available != available:
-                available = new_available
-                arguments = []
-                for interface in available:
-                    arguments.append(interface.ip+'/'+str(INTERFACES[interface.name]))
-                Controller.restart(arguments)
-            #print(available)
-            if not Controller.is_running():
-                print("Controller ended early")
-                print(Controller.process.poll() if Controller.process else "No process")
-            print(Controller.get_output())
-            time.sleep(1)
+            # Each instance is restarted only when its own interface group changed
+            pool.update(interfaces_objects)
+            lines, output_cursor, dropped = pool.read_since(output_cursor)
+            if dropped:
+                print(f"({dropped} lines of output dropped)")
+            for line in lines:
+                print(line)
+            wake.wait(scheduler.wait_time(1))
+            wake.clear()
     except Exception as er:
         print(traceback.format_exc())
     finally:
-        Controller.stop()
+        pool.stop()
+        executor.shutdown()
     input("Press Enter to exit...")
\ No newline at end of file
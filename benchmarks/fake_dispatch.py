@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""Scriptable stand-in for dispatch.exe, for benchmarks on machines without dispatch or network.
+
+    fake_dispatch.py list                        prints the interface table like `dispatch list`
+    fake_dispatch.py start [--port P] ADDRESS... listens on 127.0.0.1:P until terminated
+
+The scenario is read from the JSON file in FAKE_DISPATCH_SCENARIO on every call, so it can be changed while
+the manager runs:
+
+    {"interfaces": {"bench-0": ["10.0.0.1"]}, "startup": 0.05, "port": 1080, "crash_after": null, "wedge_after": null}
+
+`start` forwards SOCKS5 CONNECT requests (no authentication) from 127.0.0.1, enough for the end-to-end health check.
+After "wedge_after" seconds it keeps accepting connections but never answers them, like a stuck dispatch.
+
+Without a scenario file, FAKE_DISPATCH_INTERFACES interfaces named bench-N are listed.
+"""
+import json
+import os
+import signal
+import socket
+import struct
+import sys
+import threading
+import time
+
+ROW = "║ {:<33} ║ {:<38} ║"
+
+
+def load_scenario():
+    path = os.environ.get("FAKE_DISPATCH_SCENARIO")
+    if path and os.path.exists(path):
+        with open(path, encoding="utf-8") as file:
+            return json.load(file)
+    count = int(os.environ.get("FAKE_DISPATCH_INTERFACES", "1"))
+    return {"interfaces": {f"bench-{i}": [f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}"] for i in range(count)}}
+
+
+def list_interfaces(scenario):
+    print("╔" + "═" * 35 + "╦" + "═" * 40 + "╗")
+    print(ROW.format("Interface", "IP Address"))
+    for name, addresses in scenario.get("interfaces", {}).items():
+        print("╠═══════════════════════════════════╬════════════════════════════════════════╣")
+        for address in addresses:
+            print(ROW.format(name, address))
+    print("╚" + "═" * 35 + "╩" + "═" * 40 + "╝")
+
+
+def recv_exactly(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise OSError("client went away")
+        data += chunk
+    return data
+
+
+def pipe(source, destination):
+    try:
+        while True:
+            data = source.recv(65536)
+            if not data:
+                break
+            destination.sendall(data)
+    except OSError:
+        pass
+    finally:
+        for sock in (source, destination):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+def serve(client, wedged):
+    with client:
+        try:
+            if wedged.is_set():
+                while client.recv(65536):
+                    pass
+                return
+            methods = recv_exactly(client, 2)
+            recv_exactly(client, methods[1])
+            if methods[0] != 5:
+                return
+            client.sendall(b"\x05\x00")
+            version, command, _, kind = recv_exactly(client, 4)
+            if kind == 1:
+                host = socket.inet_ntop(socket.AF_INET, recv_exactly(client, 4))
+            elif kind == 4:
+                host = socket.inet_ntop(socket.AF_INET6, recv_exactly(client, 16))
+            else:
+                host = recv_exactly(client, recv_exactly(client, 1)[0]).decode("idna")
+            port = struct.unpack("!H", recv_exactly(client, 2))[0]
+            if command != 1:
+                client.sendall(b"\x05\x07\x00\x01" + bytes(6))
+                return
+            try:
+                upstream = socket.create_connection((host, port), 5)
+            except OSError:
+                client.sendall(b"\x05\x05\x00\x01" + bytes(6))
+                return
+            with upstream:
+                upstream.settimeout(None)
+                client.sendall(b"\x05\x00\x00\x01" + bytes(6))
+                threading.Thread(target=pipe, args=(upstream, client), daemon=True).start()
+                pipe(client, upstream)
+        except OSError:
+            pass
+
+
+def start(scenario, args):
+    port = int(scenario.get("port", os.environ.get("FAKE_DISPATCH_PORT", "1080")))
+    if "--port" in args:
+        port = int(args[args.index("--port") + 1])
+    time.sleep(float(scenario.get("startup", 0.05)))
+    server = socket.create_server(("127.0.0.1", port))
+    print(f"SOCKS proxy listening on 127.0.0.1:{port}", flush=True)
+    crash_after = scenario.get("crash_after")
+    if crash_after is not None:
+        threading.Timer(float(crash_after), lambda: os._exit(int(scenario.get("crash_code", 1)))).start()
+    wedged = threading.Event()
+    if scenario.get("wedge_after") is not None:
+        timer = threading.Timer(float(scenario["wedge_after"]), wedged.set)
+        timer.daemon = True
+        timer.start()
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    while True:
+        client, _ = server.accept()
+        threading.Thread(target=serve, args=(client, wedged), daemon=True).start()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ("list", "start"):
+        print("usage: fake_dispatch.py list | start [--port PORT] ADDRESS...", file=sys.stderr)
+        sys.exit(2)
+    scenario = load_scenario()
+    if sys.argv[1] == "list":
+        list_interfaces(scenario)
+    else:
+        start(scenario, sys.argv[2:])
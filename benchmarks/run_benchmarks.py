@@ -0,0 +1,238 @@
+"""Reproducible performance benchmarks of the manager, with a fake dispatch and a fake network.
+
+Runs on plain Linux with no network and no dispatch.exe:
+
+    python benchmarks/run_benchmarks.py
+    python benchmarks/run_benchmarks.py --sizes 1 10 --latency 20 --loss 0.05 --flapping 0.1 --json bench.json
+
+For every size it reports full probe cycle time, steady (presence only) cycle time, failover latency
+(from an uplink going down until the damper hands dispatch a set without it), restart downtime
+(longest window the listener refused connections during DispatchController.restart), CPU time and RSS.
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FAKE_DISPATCH = os.path.join(HERE, "fake_dispatch.py")
+BENCH_PORT = 18080
+
+# Configuration is read when InternetController is imported, so the benchmark environment goes in first
+os.environ.update({
+    "DISPATCH_EXE": FAKE_DISPATCH,
+    "FAKE_DISPATCH_PORT": str(BENCH_PORT),
+    "DISPATCH_PORT": str(BENCH_PORT),
+    "DISPATCH_STANDBY_PORTS": f"[{BENCH_PORT + 1}, {BENCH_PORT + 2}]",
+    "PROBE_BACKEND": "fake",
+    "INTERFACE_WATCHER": "poll",
+    "PROBE_INTERVAL_MIN": os.environ.get("PROBE_INTERVAL_MIN", "0.5"),
+    "PROBE_INTERVAL_MAX": os.environ.get("PROBE_INTERVAL_MAX", "2"),
+    "RESTART_SETTLE": os.environ.get("RESTART_SETTLE", "0.2"),
+    "RESTART_MIN_GAP": os.environ.get("RESTART_MIN_GAP", "0.5"),
+})
+sys.path.insert(0, os.path.dirname(HERE))
+
+import InternetController as IC  # noqa: E402
+
+
+class FakeNetwork:
+    """Probe backend with configurable latency, loss and flapping per interface address"""
+    def __init__(self, latency=20.0, jitter=5.0, loss=0.0, seed=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.down = set()
+        self.flapping = {}  # address -> (period, phase)
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def is_up(self, address):
+        if address in self.down:
+            return False
+        if address in self.flapping:
+            period, phase = self.flapping[address]
+            return (time.time() + phase) % period < period / 2
+        return True
+
+    def ping(self, adr, interface, n=4, full_stats=False):
+        rtts = []
+        sent = 0
+        for _ in range(n):
+            sent += 1
+            with self.lock:
+                rtt = max(0.1, self.random.gauss(self.latency, self.jitter))
+                lost = self.random.random() < self.loss
+            if not self.is_up(interface) or lost:
+                time.sleep(IC.PROBE_TIMEOUT / 10)  # a lost probe costs its timeout (scaled down to keep runs short)
+                if not full_stats and sent - len(rtts) >= IC.PROBE_MAX_FAILURES:
+                    break
+                continue
+            time.sleep(rtt / 1000)
+            rtts.append(rtt)
+            if not full_stats:
+                break
+        loss = round(100 * (sent - len(rtts)) / sent)
+        if not rtts:
+            return True, (sent, 0, loss), (None, None, None)
+        return True, (sent, len(rtts), loss), (min(rtts), sum(rtts) / len(rtts), max(rtts))
+
+
+def write_scenario(path, interfaces, **extra):
+    scenario = {"interfaces": interfaces}
+    scenario.update(extra)
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(scenario, file)
+
+
+def usage():
+    """(CPU seconds of this process and its children, current RSS in MiB)"""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+    rss = own.ru_maxrss / 1024
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return cpu, rss
+
+
+def measure_downtime(controller, arguments, port):
+    """Longest window of refused connections on the dispatch port while restarting"""
+    gaps = []
+    state = {"running": True, "down_since": None}
+
+    def poll():
+        while state["running"]:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+                if state["down_since"] is not None:
+                    gaps.append(time.perf_counter() - state["down_since"])
+                    state["down_since"] = None
+            except OSError:
+                if state["down_since"] is None:
+                    state["down_since"] = time.perf_counter()
+            time.sleep(0.005)
+
+    poller = threading.Thread(target=poll, daemon=True)
+    poller.start()
+    controller.restart(list(arguments))
+    IC.wait_for_port(port, 10)
+    time.sleep(0.05)
+    state["running"] = False
+    poller.join()
+    return max(gaps, default=0.0)
+
+
+def run_size(size, network, scenario_path, cycles, flapping):
+    names = [f"bench-{i}" for i in range(size)]
+    addresses = {name: [f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}"] for i, name in enumerate(names)}
+    write_scenario(scenario_path, addresses)
+    IC.INTERFACES = {name: 1 + i % 10 for i, name in enumerate(names)}
+    network.down.clear()
+    network.flapping = {addresses[name][0]: (4.0, random.random() * 4) for name in names[1:int(size * flapping) + 1]}
+
+    inventory = IC.InterfaceInventory()
+    scheduler = IC.ProbeScheduler()
+    interfaces = [IC.Interface(name, inventory=inventory, scheduler=scheduler) for name in names]
+    executor = IC.ProbeExecutor(deadline=60)
+    damper = IC.RestartDamper()
+    cpu_start, _ = usage()
+
+    full = []
+    for _ in range(cycles):
+        for interface in interfaces:
+            interface.invalidate()
+        start = time.perf_counter()
+        inventory.refresh()
+        executor.update_all(interfaces)
+        full.append(time.perf_counter() - start)
+
+    steady = []
+    for _ in range(cycles):
+        start = time.perf_counter()
+        inventory.refresh()
+        executor.update_all([interface for interface in interfaces if not scheduler.due(interface)])
+        steady.append(time.perf_counter() - start)
+
+    available = [interface for interface in interfaces if interface.last_level == 3]
+    damper.reset(available)
+    controller = IC.DispatchController(IC.dispatch_arguments(available))
+    IC.wait_for_port(BENCH_PORT, 10)
+    downtime = measure_downtime(controller, IC.dispatch_arguments(available), BENCH_PORT)
+
+    # Failover: the first (never flapping) uplink goes down
+    victim = interfaces[0]
+    network.down.add(victim.ip)
+    failover = None
+    start = time.perf_counter()
+    while time.perf_counter() - start < 30:
+        inventory.refresh()
+        executor.update_all(interfaces)
+        new_available = damper.observe(interfaces)
+        if new_available is not None and victim not in new_available:
+            failover = time.perf_counter() - start
+            break
+        time.sleep(scheduler.wait_time(0.05))
+    restarts, suppressed = damper.restarts, damper.suppressed
+    controller.stop()
+    executor.shutdown()
+    cpu_end, rss = usage()
+    return {
+        "interfaces": size,
+        "full_cycle_ms": statistics.mean(full) * 1000,
+        "full_cycle_p95_ms": sorted(full)[int(0.95 * (len(full) - 1))] * 1000,
+        "steady_cycle_ms": statistics.mean(steady) * 1000,
+        "failover_s": failover,
+        "restart_downtime_ms": downtime * 1000,
+        "damper_restarts": restarts,
+        "damper_suppressed": suppressed,
+        "cpu_s": cpu_end - cpu_start,
+        "rss_mib": rss,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 10, 100, 500])
+    parser.add_argument("--cycles", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=20.0, help="mean probe RTT in ms")
+    parser.add_argument("--jitter", type=float, default=5.0, help="RTT standard deviation in ms")
+    parser.add_argument("--loss", type=float, default=0.0, help="probability of losing a probe")
+    parser.add_argument("--flapping", type=float, default=0.0, help="share of interfaces that flap every 2 s")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="also write the results to this file")
+    options = parser.parse_args()
+
+    random.seed(options.seed)
+    network = FakeNetwork(options.latency, options.jitter, options.loss, options.seed)
+    IC.register_probe_backend("fake", network.ping)
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        scenario_path = os.path.join(directory, "scenario.json")
+        os.environ["FAKE_DISPATCH_SCENARIO"] = scenario_path
+        for size in options.sizes:
+            results.append(run_size(size, network, scenario_path, options.cycles, options.flapping))
+
+    columns = list(results[0])
+    print("  ".join(f"{column:>20}" for column in columns))
+    for result in results:
+        print("  ".join(f"{'-' if value is None else round(value, 2):>20}" for value in result.values()))
+    if options.json:
+        with open(options.json, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""Health checks through benchmarks/fake_dispatch.py to a loopback HTTP server, no network needed
+
+    python -m unittest discover tests
+"""
+import http.server
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import InternetController as IC  # noqa: E402
+
+FAKE_DISPATCH = os.path.join(ROOT, "benchmarks", "fake_dispatch.py")
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+
+def free_port():
+    with socket.create_server(("127.0.0.1", 0)) as sock:
+        return sock.getsockname()[1]
+
+
+@unittest.skipIf(os.name == "nt", "fake_dispatch.py is started as an executable")
+class HealthCheckTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        cls.url = f"http://127.0.0.1:{cls.server.server_address[1]}/"
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.saved = IC.DISPATCH_EXE, IC.HEALTH_TIMEOUT, os.environ.get("FAKE_DISPATCH_SCENARIO")
+        IC.DISPATCH_EXE, IC.HEALTH_TIMEOUT = FAKE_DISPATCH, 0.5
+        scenario = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+        scenario.close()
+        self.scenario = scenario.name
+        os.environ["FAKE_DISPATCH_SCENARIO"] = self.scenario
+        self.pool = None
+
+    def tearDown(self):
+        if self.pool:
+            self.pool.stop()
+        IC.DISPATCH_EXE, IC.HEALTH_TIMEOUT, scenario = self.saved
+        if scenario is None:
+            os.environ.pop("FAKE_DISPATCH_SCENARIO", None)
+        else:
+            os.environ["FAKE_DISPATCH_SCENARIO"] = scenario
+        os.unlink(self.scenario)
+
+    def start_pool(self, **scenario):
+        with open(self.scenario, "w", encoding="utf-8") as file:
+            json.dump(dict(scenario, interfaces={}), file)
+        interface = IC.Interface("health-lo")
+        interface.ip, interface.last_level = "127.0.0.1", 3
+        self.pool = IC.DispatchPool([{"name": "health", "port": free_port(), "interfaces": {"health-lo": 1}}])
+        self.assertTrue(self.pool.start([interface]))
+        return self.pool.instances[0]
+
+    def test_passing_check(self):
+        instance = self.start_pool()
+        connect, ttfb = IC.proxy_probe(self.url, instance.port, "127.0.0.1")
+        self.assertGreaterEqual(connect, 0)
+        self.assertGreaterEqual(ttfb, 0)
+        IC.HealthChecker(self.pool, url=self.url).run_once()
+        self.assertEqual(instance.health.last["result"], "ok")
+        self.assertEqual(instance.health.restarts, 0)
+
+    def test_wedged_dispatch_is_restarted_once(self):
+        # Accepts connections but never answers, also right after every restart
+        instance = self.start_pool(wedge_after=0)
+        instance.health.max_failures = 2
+        checker = IC.HealthChecker(self.pool, url=self.url)
+        first = instance.controller.process
+        for _ in range(2):
+            checker.run_once()
+        self.assertEqual(instance.health.restarts, 1)
+        restarted = instance.controller.process
+        self.assertIsNot(restarted, first)
+        for _ in range(4):
+            checker.run_once()
+        self.assertEqual(instance.health.last["result"], "failed")
+        self.assertEqual(instance.health.restarts, 1)
+        self.assertTrue(instance.health.holding)
+        self.assertIs(instance.controller.process, restarted)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,36 @@
+"""ProbeHistory windowed summaries
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import InternetController as IC  # noqa: E402
+
+
+class ProbeHistoryTest(unittest.TestCase):
+    def test_percentiles_of_few_samples(self):
+        history = IC.ProbeHistory(8)
+        history.append(3, 41, 0.0, timestamp=100)
+        history.append(3, 51, 0.0, timestamp=110)
+        summary = history.summary(window=60, now=120)
+        self.assertEqual(summary["rtt_p50"], 41)
+        self.assertEqual(summary["rtt_p95"], 51)
+
+    def test_window_availability_and_flaps(self):
+        history = IC.ProbeHistory(4)
+        for index, level in enumerate([0, 3, 3, 0, 3, 3]):  # the first two are overwritten
+            history.append(level, 10 if level == 3 else None, timestamp=1000 + 10 * index)
+        summary = history.summary(window=1000, now=1060)
+        self.assertEqual(summary["samples"], 4)
+        self.assertEqual(summary["flaps"], 2)
+        self.assertEqual(summary["availability"], 75.0)
+        rows, cursor, dropped = history.read_since(0)
+        self.assertEqual((len(rows), cursor, dropped), (4, 6, 2))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+"""Native probes against loopback, no network needed (ICMP tests are skipped where ICMP sockets aren't permitted)
+
+    python -m unittest discover tests
+"""
+import os
+import socket
+import struct
+import sys
+import threading
+import types
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import InternetController as IC  # noqa: E402
+
+# TEST-NET-2, never answers
+UNREACHABLE = "198.51.100.1"
+
+
+class TcpProbeTest(unittest.TestCase):
+    def setUp(self):
+        self.server = socket.create_server(("127.0.0.1", 0))
+        self.port = self.server.getsockname()[1]
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_connect_time_to_listener(self):
+        rtt = IC.tcp_probe("127.0.0.1", "127.0.0.1", self.port)
+        self.assertIsNotNone(rtt)
+        self.assertGreaterEqual(rtt, 0)
+
+    def test_closed_port_is_lost(self):
+        with socket.create_server(("127.0.0.1", 0)) as closed:
+            port = closed.getsockname()[1]
+        self.assertIsNone(IC.tcp_probe("127.0.0.1", None, port, timeout=0.5))
+
+    def test_native_ping_result_shape(self):
+        port, IC.PROBE_PORT = IC.PROBE_PORT, self.port
+        try:
+            dns, packets, pings = IC.native_ping("127.0.0.1", None, n=4, method="tcp", full_stats=False)
+        finally:
+            IC.PROBE_PORT = port
+        self.assertTrue(dns)
+        self.assertEqual(packets, (1, 1, 0))  # stops at the first reply
+        self.assertIsNotNone(pings[1])
+
+
+class IcmpReplyTest(unittest.TestCase):
+    sock = types.SimpleNamespace(family=socket.AF_INET, type=socket.SOCK_RAW)
+
+    def reply(self, ident, seq):
+        return struct.pack("!BBHHH", 0, 0, 0, ident, seq) + b"dispatch-proxy-manager"
+
+    def test_sequence_numbers_are_unique(self):
+        _, first = IC.icmp_echo_packet(socket.AF_INET, "127.0.0.1")
+        _, second = IC.icmp_echo_packet(socket.AF_INET, "127.0.0.1")
+        self.assertNotEqual(first[2], second[2])
+
+    def test_reply_must_come_from_the_target(self):
+        _, expected = IC.icmp_echo_packet(socket.AF_INET, UNREACHABLE)
+        data = self.reply(expected[1], expected[2])
+        self.assertTrue(IC.icmp_is_reply(self.sock, data, expected, UNREACHABLE))
+        self.assertFalse(IC.icmp_is_reply(self.sock, data, expected, "127.0.0.1"))
+
+    def test_reply_to_another_probe_is_ignored(self):
+        _, expected = IC.icmp_echo_packet(socket.AF_INET, "127.0.0.1")
+        _, other = IC.icmp_echo_packet(socket.AF_INET, "127.0.0.1")
+        self.assertFalse(IC.icmp_is_reply(self.sock, self.reply(other[1], other[2]), expected, "127.0.0.1"))
+
+
+@unittest.skipIf(IC._icmp_socket(socket.AF_INET) is None, "ICMP sockets are not permitted")
+class IcmpProbeTest(unittest.TestCase):
+    def test_loopback_replies(self):
+        self.assertIsNotNone(IC.icmp_probe("127.0.0.1", None, timeout=1))
+
+    def test_concurrent_probes_keep_their_own_replies(self):
+        results = {}
+
+        def probe(target):
+            results[target] = IC.icmp_probe(target, None, timeout=0.5)
+
+        threads = [threading.Thread(target=probe, args=(target,)) for target in (UNREACHABLE, "127.0.0.1")]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertIsNotNone(results["127.0.0.1"])
+        self.assertIsNone(results[UNREACHABLE])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+"""Throughput probe against a loopback HTTP server, no network needed
+
+    python -m unittest discover tests
+"""
+import http.server
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import InternetController as IC  # noqa: E402
+
+BODY = bytes(range(256)) * 400  # 102400 bytes
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """/range honours the Range header (206), /full ignores it (200), anything else is a 404"""
+    def do_GET(self):
+        if self.path == "/range":
+            first, last = self.headers["Range"].split("=")[1].split("-")
+            data = BODY[int(first):int(last) + 1]
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {first}-{int(first) + len(data) - 1}/{len(BODY)}")
+        elif self.path == "/full":
+            data = BODY
+            self.send_response(200)
+        else:
+            self.send_error(404)
+            return
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThroughputTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        cls.url = f"http://127.0.0.1:{cls.server.server_address[1]}"
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def test_partial_content(self):
+        received, goodput = IC.measure_throughput(self.url + "/range", "127.0.0.1", nbytes=5000, timeout=2)
+        self.assertEqual(received, 5000)
+        self.assertGreater(goodput, 0)
+
+    def test_full_response_is_capped(self):
+        # The server ignores the Range header, only nbytes of the body count
+        received, _ = IC.measure_throughput(self.url + "/full", "127.0.0.1", nbytes=3000, timeout=2)
+        self.assertEqual(received, 3000)
+        received, _ = IC.measure_throughput(self.url + "/full", "127.0.0.1", nbytes=len(BODY) * 2, timeout=2)
+        self.assertEqual(received, len(BODY))  # shorter than asked for, the download ends with the response
+
+    def test_error_status(self):
+        with self.assertRaises(OSError):
+            IC.measure_throughput(self.url + "/missing", "127.0.0.1", nbytes=1000, timeout=2)
+
+    def test_hourly_budget(self):
+        interfaces = [IC.Interface(name) for name in ("throughput-a", "throughput-b")]
+        for interface in interfaces:
+            interface.ip, interface.last_level = "127.0.0.1", 3
+        prober = IC.ThroughputProber(interfaces, url=self.url + "/range", nbytes=4000, budget=6000)
+        prober.run_once()
+        self.assertIsNotNone(interfaces[0].goodput)
+        self.assertIsNone(interfaces[1].goodput)  # the second download would go over the budget
+        self.assertEqual(interfaces[0].capacity_share, 1.0)
+        self.assertEqual(prober.budget_left(), 2000)
+        # An hour later the first download no longer counts
+        prober.spent[0] = (time.time() - 3600, prober.spent[0][1])
+        self.assertEqual(prober.budget_left(), 6000)
+        interfaces[0].last_level = 2  # not probed any more, the budget goes to the other one
+        prober.run_once()
+        self.assertIsNotNone(interfaces[1].goodput)
+
+
+if __name__ == "__main__":
+    unittest.main()